@@ -2,13 +2,14 @@ import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 from tkinter import messagebox
 from gantry_controller import Beast  # Assuming your Beast class is in a file named beast.py
+from storage import FilamentSlot
 
 class GantryControlApp:
     def __init__(self, master):
         self.master = master
         self.master.title("Gantry Control")
         self.master.geometry("600x450")
-        self.beast = Beast()
+        self.beast = Beast(lazy=True)
 
         # Main Frame
         self.main_frame = ttk.Frame(master, padding=20)
@@ -83,7 +84,7 @@ class GantryControlApp:
         try:
             slot = int(self.slot_var.get())
             if 1 <= slot <= 4:
-                self.beast.activeSlot = slot
+                self.beast.activeSlot = FilamentSlot.from_number(slot)
                 self.beast.change_active_slot()
                 messagebox.showinfo("Success", f"Filament slot set to {slot}")
             else:
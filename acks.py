@@ -0,0 +1,103 @@
+import functools
+import re
+
+class Outcome:
+    SUCCESS = "success"
+    FAILURE = "failure"  # The board reported an error before acknowledging
+    NEGATIVE = "negative"  # The board answered no, like "Intake empty", which is not an error
+    TIMEOUT = "timeout"
+    STALLED = "stalled"  # Overdue against the learned duration, see durations.py
+    PROGRESS = "progress"  # Only for classify, a wait never ends on progress
+
+# Lines any MicroPython board prints when a command dies, whatever the command
+DEVICE_FAILURES = (
+    r"^Traceback \(most recent call last\)",
+    r"^ERROR\b",
+    r"^[A-Za-z_]*(?:Error|Exception|Interrupt)(?::|$)",  # The last line of a traceback
+)
+TRACEBACK_FRAME = re.compile(r"^\s*File \"")
+
+class Ack:
+    # What a command prints when it is done. The success message is matched literally,
+    # also without its first character since that is sometimes lost. failure,
+    # negative and progress are regular expressions for whole lines. A failure or a
+    # negative answer ends the wait at once, only a failure counts as an error.
+    # Patterns are compiled when the Ack is made, so define Acks once.
+    def __init__(self, message, failure=(), progress=(), negative=()):
+        self.message = message
+        self.failure = tuple(failure)
+        self.progress = tuple(progress)
+        self.negative = tuple(negative)
+        self._failure = re.compile("|".join(f"(?:{pattern})" for pattern in DEVICE_FAILURES + self.failure))
+        self._progress = re.compile("|".join(f"(?:{pattern})" for pattern in self.progress)) if progress else None
+        self._negative = re.compile("|".join(f"(?:{pattern})" for pattern in self.negative)) if negative else None
+
+    def classify(self, line):
+        # The Outcome a line stands for, None for lines unrelated to the command
+        if line == self.message or line == self.message[1:]:
+            return Outcome.SUCCESS
+        if self._negative is not None and self._negative.search(line):
+            return Outcome.NEGATIVE
+        if self._failure.search(line):
+            return Outcome.FAILURE
+        if self._progress is not None and self._progress.search(line):
+            return Outcome.PROGRESS
+        return None
+
+    def __repr__(self):
+        return f"Ack({self.message!r})"
+
+@functools.lru_cache(maxsize=256)
+def _plain(message):
+    return Ack(message)
+
+def ack_for(ack):
+    # Callers may pass a plain success message, those share one cached Ack
+    return ack if isinstance(ack, Ack) else _plain(ack)
+
+class AckResult:
+    # How a wait for an acknowledgement ended. True only on success, so code that
+    # treats the wait as a bool keeps working.
+    def __init__(self, outcome, line=None, detail=None, progress=(), seconds=0.0):
+        self.outcome = outcome
+        self.line = line  # The success, negative or failure line, None on timeout
+        self.detail = detail  # The exception line of a traceback
+        self.progress = list(progress)
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        return self.outcome == Outcome.SUCCESS
+
+    def __bool__(self):
+        return self.ok
+
+    @property
+    def reason(self):
+        # One line for logs and the UI
+        if self.outcome == Outcome.FAILURE:
+            return self.detail or self.line
+        if self.outcome == Outcome.STALLED:
+            return f"stalled after {self.seconds:.1f}s"
+        if self.outcome == Outcome.TIMEOUT:
+            return f"timed out after {self.seconds:.1f}s"
+        return self.line
+
+    def as_dict(self):
+        return {"outcome": self.outcome, "line": self.line, "detail": self.detail,
+                "progress": self.progress, "secs": round(self.seconds, 3)}
+
+    def __repr__(self):
+        return f"AckResult({self.outcome!r}, {self.reason!r})"
+
+def wait_for_ack(talker, ack, timeout=30):
+    # The wait every subsystem uses after sending a command: prints how it ended and
+    # returns the AckResult. A negative answer is the caller's to report.
+    result = talker.wait_for(ack, timeout)
+    if result:
+        print(ack_for(ack).message)
+    elif result.outcome == Outcome.FAILURE:
+        print(f"Board error: {result.reason}")
+    elif result.outcome != Outcome.NEGATIVE:
+        print("Operation timed out.")
+    return result
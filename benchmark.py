@@ -0,0 +1,93 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import time
+from durations import percentile
+from gantry_controller import Beast
+from simulator import VirtualMicrofactory
+
+STEPS = [
+    ("home_state", lambda beast, args: beast.home_state()),
+    ("move_to_storage", lambda beast, args: beast.move_gantry_to("storage_1")),
+    ("load_gantry", lambda beast, args: beast.load_gantry_with_filament(args.amount_secs, args.speed)),
+    ("move_to_printer", lambda beast, args: beast.move_gantry_to("printer_1")),
+    ("load_printer", lambda beast, args: beast.load_printer_with_filament()),
+]
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 0.50),
+        "p90": percentile(samples, 0.90),
+        "p99": percentile(samples, 0.99),
+        "max": max(samples),
+    }
+
+def run(args):
+    timings = {name: [] for name, _ in STEPS}
+    timings["cycle"] = []
+    with contextlib.ExitStack() as stack:
+        factory = stack.enter_context(VirtualMicrofactory(scale=args.device_scale))
+        beast = Beast(**factory.ports)
+        stack.callback(beast.close)
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        beast.change_active_slot()
+        for cycle_index in range(args.warmup + args.cycles):
+            cycle = {}
+            cycle_start = time.perf_counter()
+            for name, step in STEPS:
+                start = time.perf_counter()
+                step(beast, args)
+                cycle[name] = time.perf_counter() - start
+            cycle["cycle"] = time.perf_counter() - cycle_start
+            if cycle_index < args.warmup:
+                continue
+            for name, elapsed in cycle.items():
+                timings[name].append(elapsed)
+    return {name: summarize(samples) for name, samples in timings.items()}
+
+def report(results, baseline=None, threshold=0.10):
+    regressions = []
+    print(f"{'step (ms)':<18}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}  vs baseline p50")
+    for name, stats in results.items():
+        line = f"{name:<18}" + "".join(f"{stats[key] * 1000:>10.1f}" for key in ["mean", "p50", "p90", "p99", "max"])
+        if baseline and name in baseline["results"]:
+            before = baseline["results"][name]["p50"]
+            change = (stats["p50"] - before) / before if before else 0.0
+            line += f"  {change:+.1%}"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time Beast workflows against the virtual microfactory")
+    parser.add_argument("--cycles", type=int, default=10, help="Measured load cycles")
+    parser.add_argument("--warmup", type=int, default=1, help="Cycles run before measuring")
+    parser.add_argument("--device-scale", type=float, default=0.0,
+                        help="Multiplier for simulated device latencies, 0 measures host overhead only")
+    parser.add_argument("--amount-secs", type=int, default=60)
+    parser.add_argument("--speed", type=int, default=1)
+    parser.add_argument("--save", help="Write the results to this JSON file, e.g. as a new baseline")
+    parser.add_argument("--baseline", help="Compare against results previously written with --save")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Keep the workflow console output")
+    args = parser.parse_args()
+
+    config = {"cycles": args.cycles, "device_scale": args.device_scale}
+    results = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"config": config, "python": platform.python_version(), "results": results}, f, indent=2)
+    if regressions:
+        raise SystemExit(f"Regressions in: {', '.join(regressions)}")
@@ -1,32 +1,357 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+import asyncio
+import contextvars
+import itertools
+import re
+import threading
+from collections import OrderedDict, deque
+from metrics import METRICS
+from recorder import Kind
 import serial
 import time
+from acks import TRACEBACK_FRAME, AckResult, Outcome, ack_for, wait_for_ack
+
+class SerialLoop:
+    """Background asyncio event loop that owns the reader coroutine of every port."""
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="serial-loop", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = SerialLoop()
+            return cls._instance
+
+    def run(self, coro):
+        # Blocking entry point for synchronous callers
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("Cannot block on the serial loop from inside the serial loop")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def run_async(self, coro):
+        # Awaitable entry point for callers running on another event loop
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+TAGGED_LINE = re.compile(r"^@(\d+) ?(.*)$")
+REPL_PROMPT = re.compile(r"^(>>> ?)+")
+EVENT_LINE = re.compile(r"^EVENT (\w+)(?: (\S+))?$")  # Pushed by boards with events subscribed
+
+_waits = threading.local()
+
+def last_failure():
+    # Why this thread's last wait for an ack failed, None if it did not or if the
+    # thread has sent a command since. Used to explain a subsystem call that
+    # returned False.
+    return getattr(_waits, "reason", None)
+
+def _waited(result):
+    failed = result.outcome not in (Outcome.SUCCESS, Outcome.NEGATIVE)
+    _waits.reason = result.reason if failed else None
+    return result
+
+class LineFramer:
+    # Splits a byte stream into lines ending in \r\n, \r or \n. Bytes wait in one
+    # reusable buffer, and every complete line in a chunk is decoded in one go
+    # straight from a view of the buffer instead of being copied out line by line.
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        # Returns the stripped, non-empty lines completed by data. Blank lines are
+        # dropped, which also covers a \r\n split across two chunks.
+        buffer = self._buffer
+        buffer += data
+        end = max(buffer.rfind(b"\n"), buffer.rfind(b"\r")) + 1
+        if not end:
+            return []
+        with memoryview(buffer) as view:
+            text = str(view[:end], "utf-8", "replace")
+        del buffer[:end]
+        return [line for line in map(str.strip, text.replace("\r", "\n").split("\n")) if line]
 
 class Talker:
-    TERMINATOR = '\r'.encode('UTF8')
+    HISTORY = 1000  # Lines kept for waiters that subscribe after the line arrived
+    MAX_REQUESTS = 256  # Framed requests whose replies are still tracked
 
-    def __init__(self, port, timeout=1):
-        self.serial = serial.Serial(port, 115200, timeout=timeout)
+    def __init__(self, port, timeout=1, name=None, framed=False, recorder=None, on_line=None, durations=None):
+        self.port = port
+        self.timeout = timeout
+        self.name = name or port  # Subsystem label used in metrics
+        # Framed mode sends "@<id> <command>" and the board tags every reply line
+        # with the same id, so several commands can be in flight on one board
+        self.framed = framed
+        self.recorder = recorder  # Optional recorder.TrafficRecorder logging every byte
+        self.on_line = on_line  # Called on the serial loop with every non-empty line received
+        self.durations = durations  # Optional durations.DurationModel that shortens waits for stalled commands
+        self._tags = itertools.count(1)
+        self._request = contextvars.ContextVar(f"request_{port}", default=None)
+        self.last_command = None
+        self.last_command_time = 0.0
+        self._last_wait_timed_out = False
+        self.error = None  # Why the port stopped working, None while it works
+        # The port is non-blocking, the reader coroutine is woken by the event loop
+        self.serial = serial.Serial(port, 115200, timeout=0)
+        self._serial_loop = SerialLoop.get()
+        self._serial_loop.run(self._start())
 
-    def send(self, text: str):
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+        self._lines = deque(maxlen=self.HISTORY)  # (sequence number, tag, line)
+        self._next_seq = 0
+        self._cursor = 0  # Sequence number of the first untagged line not yet consumed
+        self._requests = OrderedDict()  # tag -> [cursor, command, time sent]
+        self._waiters = []
+        self._data_ready = asyncio.Event()
+        try:
+            loop.add_reader(self.serial.fileno(), self._data_ready.set)
+            self._polling = False
+        except (NotImplementedError, AttributeError):
+            # No selectable file descriptor (e.g. Windows), fall back to polling
+            self._polling = True
+        self._reader = loop.create_task(self._read_lines())
+
+    async def _read_lines(self):
+        framer = LineFramer()
+        while True:
+            if self._polling:
+                await asyncio.sleep(0.01)
+            else:
+                await self._data_ready.wait()
+                self._data_ready.clear()
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                print(f"Error: {self.port} read failed: {e}")
+                self.error = f"read failed: {e}"
+                return
+            if not data:
+                continue
+            if self.recorder is not None:
+                self.recorder.record(self.name, self.port, Kind.RECEIVED, data)
+            for line in framer.feed(data):
+                self._dispatch(line)
+
+    def _dispatch(self, line):
+        print(f"Received: {line}")
+        # Output pushed while the board is idle follows the REPL prompt
+        line = REPL_PROMPT.sub('', line)
+        tag = None
+        tagged = TAGGED_LINE.match(line)
+        if tagged:
+            tag = int(tagged.group(1))
+            line = tagged.group(2)
+        if line and self.on_line is not None:
+            self.on_line(line)
+        seq = self._next_seq
+        self._next_seq += 1
+        self._lines.append((seq, tag, line))
+        for waiter in list(self._waiters):
+            waiter_tag, matcher, future, since = waiter
+            start = self._get_cursor(tag) if since is None else since
+            if waiter_tag == tag and seq >= start and not future.done() and matcher(line):
+                if since is None:
+                    self._set_cursor(tag, seq + 1)
+                self._waiters.remove(waiter)
+                future.set_result(line)
+
+    def _get_cursor(self, tag):
+        if tag is None:
+            return self._cursor
+        request = self._requests.get(tag)
+        # Tagged lines for requests we no longer track are never consumed
+        return request[0] if request else self._next_seq
+
+    def _set_cursor(self, tag, seq):
+        if tag is None:
+            self._cursor = seq
+        elif tag in self._requests:
+            self._requests[tag][0] = seq
+
+    async def _next_line(self, matcher, timeout, tag=None, since=None):
+        # Consume lines up to and including the first match, None on timeout.
+        # With since set, look at lines from that sequence number without consuming them.
+        start = self._get_cursor(tag) if since is None else since
+        for seq, line_tag, line in self._lines:
+            if line_tag == tag and seq >= start and matcher(line):
+                if since is None:
+                    self._set_cursor(tag, seq + 1)
+                return line
+        future = asyncio.get_running_loop().create_future()
+        waiter = (tag, matcher, future, since)
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    async def _send(self, text: str, tag=None):
+        if tag is not None:
+            await self._send_framed(text, tag)
+            return
+        # Lines already received cannot be the reply to this command
+        self._cursor = self._next_seq
+        self._record_command(text)
         # Ensure the text is formatted with carriage return
         line = '%s\r\f' % text
-        self.serial.write(line.encode('utf-8'))
-        reply = self.receive()
-        reply = reply.replace('>>> ', '')  # Remove the REPL prompt      
+        self._write(line.encode('utf-8'))
+        reply = await self._receive()
+        if reply:
+            METRICS.observe_echo(self.name, text, time.monotonic() - self.last_command_time)
+        reply = reply.replace('>>> ', '')  # Remove the REPL prompt
         if reply != text:  # The line should be echoed
             #raise ValueError(f'Expected "{text}" got "{reply}"')
             print(f'Expected reply of"{text}" got "{reply}"')
 
+    async def _send_blind(self, text: str, tag=None):
+        if tag is not None:
+            await self._send_framed(text, tag)
+            return
+        self._cursor = self._next_seq
+        self._record_command(text)
+        # Ensure the text is formatted with carriage return and form feed
+        line = '%s\r\f' % text
+        self._write(line.encode('utf-8'))
+
+    async def _send_framed(self, text, tag):
+        # No echo in framed mode, replies are routed by tag instead
+        self._record_command(text)
+        self._requests[tag] = [self._next_seq, text, self.last_command_time]
+        while len(self._requests) > self.MAX_REQUESTS:
+            self._requests.popitem(last=False)
+        line = '@%d %s\r\f' % (tag, text)
+        self._write(line.encode('utf-8'))
+
+    def _write(self, data):
+        self.serial.write(data)
+        if self.recorder is not None:
+            self.recorder.record(self.name, self.port, Kind.SENT, data)
+
+    def _new_request(self):
+        # Tags the caller's context (thread or task) so its waits see only its replies
+        if not self.framed:
+            return None
+        tag = next(self._tags)
+        self._request.set(tag)
+        return tag
+
+    def _record_command(self, text):
+        if self._last_wait_timed_out and text == self.last_command:
+            METRICS.count_retry(self.name, text)
+        self._last_wait_timed_out = False
+        self.last_command = text
+        self.last_command_time = time.monotonic()
+
+    async def _receive(self, timeout=None, tag=None) -> str:
+        # Returns an empty string on timeout, like a serial read_until would. Pushed
+        # events are left to wait_event, so they are never taken for an echo or reply.
+        if timeout is None:
+            timeout = self.timeout
+        line = await self._next_line(lambda line: not EVENT_LINE.match(line), timeout, tag)
+        return '' if line is None else line
+
+    async def _wait_for(self, ack, timeout=30, tag=None):
+        if tag in self._requests:
+            _, command, sent_time = self._requests[tag]
+        else:
+            command, sent_time = self.last_command, self.last_command_time
+        return await self._await_ack(ack, command, timeout, sent_time, tag)
+
+    async def _await_ack(self, ack, command, timeout, started, tag=None):
+        # Waits for the ack of command, which started at the given monotonic time, and
+        # returns an AckResult. The wait ends early on a failure line, and when a
+        # command's learned deadline has passed it counts as stalled.
+        ack = ack_for(ack)
+        deadline = timeout
+        if self.durations is not None:
+            deadline = self.durations.deadline(self.name, command, ack.message, timeout)
+        wait = timeout if deadline >= timeout else max(0.0, started + deadline - time.monotonic())
+        progress = []
+
+        def matcher(line):
+            outcome = ack.classify(line)
+            if outcome == Outcome.PROGRESS:
+                progress.append(line)
+            return outcome in (Outcome.SUCCESS, Outcome.FAILURE, Outcome.NEGATIVE)
+
+        line = await self._next_line(matcher, wait, tag)
+        elapsed = time.monotonic() - started
+        if line is None:
+            self._last_wait_timed_out = True
+            METRICS.count_timeout(self.name, command)
+            if deadline < timeout:
+                METRICS.count_stall(self.name, command)
+                print(f"Error: {self.name} stalled on {command}, no \"{ack.message}\" after {elapsed:.1f}s"
+                      f" (usually within {deadline:.1f}s)")
+                return AckResult(Outcome.STALLED, progress=progress, seconds=elapsed)
+            return AckResult(Outcome.TIMEOUT, progress=progress, seconds=elapsed)
+        outcome = ack.classify(line)
+        if outcome == Outcome.NEGATIVE:
+            # An answer, not an error: nothing is counted or printed
+            return AckResult(Outcome.NEGATIVE, line, progress=progress, seconds=elapsed)
+        if outcome == Outcome.FAILURE:
+            METRICS.count_failure(self.name, command)
+            detail = None
+            if line.startswith("Traceback"):
+                # The exception follows the stack frames, usually in the same read
+                detail = await self._next_line(lambda line: not TRACEBACK_FRAME.match(line), 0.5, tag)
+            print(f"Error: {self.name} failed on {command}: {detail or line}")
+            return AckResult(Outcome.FAILURE, line, detail, progress, elapsed)
+        METRICS.observe_ack(self.name, command, elapsed)
+        if self.durations is not None:
+            self.durations.record(self.name, command, ack.message, elapsed)
+        return AckResult(Outcome.SUCCESS, line, progress=progress, seconds=elapsed)
+
+    async def _query(self, expression, timeout, tag=None):
+        await self._send(expression, tag)
+        line = await self._receive(timeout, tag)
+        return line or None
+
+    async def _wait_event(self, name, timeout, since):
+        def matcher(line):
+            event = EVENT_LINE.match(line)
+            return event is not None and event.group(1) == name
+        line = await self._next_line(matcher, timeout, since=since)
+        if line is None:
+            return None
+        # The device timestamp, or True for events sent without one
+        return EVENT_LINE.match(line).group(2) or True
+
+    async def _clear(self):
+        self.serial.reset_input_buffer()
+        self.serial.reset_output_buffer()
+        self._cursor = self._next_seq
+
+    async def _close(self):
+        if not self._polling:
+            asyncio.get_running_loop().remove_reader(self.serial.fileno())
+        self._reader.cancel()
+        self.serial.close()
+
+    def send(self, text: str):
+        _waits.reason = None
+        self._serial_loop.run(self._send(text, self._new_request()))
+
     # def send(self, text: str):
     #     # Clear buffers before sending
     #     self.clear_buffer()
-        
+
     #     # Ensure the text is formatted with carriage return and form feed
     #     line = '%s\r\f' % text
     #     self.serial.write(line.encode('utf-8'))
-        
+
     #     while True:
     #         reply = self.receive()
     #         if reply == '>>>':
@@ -38,26 +363,172 @@ class Talker:
 
     #     # No need for the previous equality check since we handle it in the loop
 
-        
+
     def send_blind(self, text: str):
-        # Ensure the text is formatted with carriage return and form feed
-        line = '%s\r\f' % text
-        self.serial.write(line.encode('utf-8'))
+        # Input for the command still running, so in framed mode it joins that command's request
+        self._serial_loop.run(self._send_blind(text, self._request.get() or self._new_request()))
 
     def receive(self) -> str:
-        line = self.serial.read_until(self.TERMINATOR)
-        return line.decode('UTF8').strip()
+        return self._serial_loop.run(self._receive(tag=self._request.get()))
+
+    def wait_for(self, ack, timeout=30):
+        # ack is a success message or an acks.Ack, returns an acks.AckResult
+        return _waited(self._serial_loop.run(self._wait_for(ack, timeout, self._request.get())))
+
+    @property
+    def ready(self):
+        return self.error is None
+
+    def query(self, expression, timeout=1):
+        # Evaluate an expression on the board, returns the line it prints or None
+        return self._serial_loop.run(self._query(expression, timeout, self._new_request()))
+
+    def mark(self):
+        # Sequence number of the next line, pass it to wait_event to ignore older events
+        return self._next_seq
+
+    def wait_event(self, name, timeout=30, since=None):
+        if since is None:
+            since = self.mark()
+        return self._serial_loop.run(self._wait_event(name, timeout, since))
+
+    async def send_async(self, text: str):
+        await self._serial_loop.run_async(self._send(text, self._new_request()))
+
+    async def receive_async(self) -> str:
+        return await self._serial_loop.run_async(self._receive(tag=self._request.get()))
+
+    async def wait_for_async(self, ack, timeout=30):
+        return await self._serial_loop.run_async(self._wait_for(ack, timeout, self._request.get()))
+
+    async def wait_event_async(self, name, timeout=30, since=None):
+        if since is None:
+            since = self.mark()
+        return await self._serial_loop.run_async(self._wait_event(name, timeout, since))
 
     def close(self):
-        self.serial.close()
+        self._serial_loop.run(self._close())
 
     def clear_buffer(self):
         """Clears the serial input and output buffers."""
-        self.serial.reset_input_buffer()
-        self.serial.reset_output_buffer()
-        # Read and discard any data in the input buffer
-        while self.serial.in_waiting:
-            self.serial.read(self.serial.in_waiting)
+        self._serial_loop.run(self._clear())
+
+class LazyTalker:
+    # Stands in for a Talker whose port is opened in the background, retrying with
+    # backoff until the board is there. Using it before then blocks until the port
+    # is open, or raises ConnectionError after READY_TIMEOUT seconds.
+    READY_TIMEOUT = 30
+    RETRY_DELAY = 0.5
+    MAX_RETRY_DELAY = 30
+
+    def __init__(self, port, **kwargs):
+        self.port = port
+        self.name = kwargs.get("name") or port
+        self.attempts = 0
+        self._kwargs = kwargs
+        self._talker = None
+        self._error = None
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def start(self, setup=None):
+        # setup is called with the new Talker in place, before anyone else may use it
+        self._thread = threading.Thread(target=self._connect, args=(setup,), name=f"connect-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _connect(self, setup):
+        delay = self.RETRY_DELAY
+        while not self._closed.is_set():
+            self.attempts += 1
+            try:
+                self._talker = Talker(self.port, **self._kwargs)
+                if setup is not None:
+                    setup()
+            except Exception as e:
+                self._error = str(e)
+                print(f"Error: {self.name} not connected, retrying in {delay}s: {e}")
+                if self._talker is not None:
+                    self._talker.close()
+                    self._talker = None
+                self._closed.wait(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+                continue
+            self._error = None
+            self._ready.set()
+            print(f"{self.name} connected on {self.port}")
+            return
+
+    @property
+    def ready(self):
+        return self._ready.is_set() and self._talker.ready
 
+    @property
+    def error(self):
+        if self._talker is not None and self._ready.is_set():
+            return self._talker.error
+        return self._error
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def talker(self):
+        # The connecting thread uses the Talker for setup before it is ready
+        if threading.current_thread() is self._thread and self._talker is not None:
+            return self._talker
+        if not self._ready.wait(self.READY_TIMEOUT):
+            raise ConnectionError(f"{self.name} not connected: {self._error or 'connecting'}")
+        return self._talker
+
+    # Read by status reporting, which must not wait for the board
+    @property
+    def last_command(self):
+        return self._talker.last_command if self._talker is not None else None
+
+    @last_command.setter
+    def last_command(self, value):
+        self.talker().last_command = value
+
+    @property
+    def last_command_time(self):
+        return self._talker.last_command_time if self._talker is not None else 0.0
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.talker(), name)
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._talker is not None:
+            self._talker.close()
 
+class SensorEvents:
+    # For subsystems, with a talker, whose board can push its sensor edges
+    def subscribe_events(self):
+        # Ask the board to push sensor edges as "EVENT <name> <ticks_ms>" lines
+        try:
+            command = "subscribe_events()"
+            self.talker.send(command)
+            print("Subscribing to sensor events...")
+            complete = wait_for_ack(self.talker, "Events subscribed", 5)
+            if complete:
+                print("Events subscribed")
+                return True
+            else:
+                print("ERROR: Event subscription unsuccessful")
+                return False
+        except ValueError as e:
+            print(f"Error: {e}")
+            return False
 
+    def wait_for_intake_event(self, since, timeout=120):
+        # since is a talker.mark() taken before the filament was set moving
+        timestamp = self.talker.wait_event("intake", timeout, since)
+        if timestamp is None:
+            print("ERROR: Intake not triggered within timeout")
+            return False
+        print(f"Intake triggered at {timestamp}")
+        return True
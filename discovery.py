@@ -0,0 +1,85 @@
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from serial.tools import list_ports
+from state_store import write_json_atomic
+
+# Firmware answers identify() with its role ("gantry" or the station it serves) and machine.unique_id()
+IDENTITY_LINE = re.compile(r"IDENTITY (\S+) (\S+)")
+
+class PortDiscovery:
+    # Finds which serial port each board is on, whatever order USB enumerated them in.
+    # Ports are identified by handshake in parallel, and the role of every USB serial
+    # number seen is cached so a known board is not opened again on the next start.
+    def __init__(self, cache_path=None, timeout=2):
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.cache = self._load()  # USB serial number -> role
+
+    def _load(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self):
+        if self.cache_path:
+            # A crash mid-write must not leave a cache that fails to load
+            write_json_atomic(self.cache_path, self.cache, indent=2)
+
+    def candidates(self):
+        # (device, USB serial number) of every USB serial port
+        return [(port.device, port.serial_number) for port in list_ports.comports() if port.vid is not None]
+
+    def handshake(self, device):
+        # Returns (role, board id), or None if nothing on the port identifies itself
+        try:
+            with serial.Serial(device, 115200, timeout=0.1) as port:
+                port.reset_input_buffer()
+                port.write(b"identify()\r\f")
+                deadline = time.monotonic() + self.timeout
+                while time.monotonic() < deadline:
+                    line = port.readline().decode("utf-8", errors="replace")
+                    identity = IDENTITY_LINE.search(line)
+                    if identity:
+                        return identity.group(1), identity.group(2)
+        except (serial.SerialException, OSError) as e:
+            print(f"Error: handshake on {device} failed: {e}")
+        return None
+
+    def discover(self, candidates=None, refresh=False):
+        # Returns {role: device}. candidates is a list of (device, USB serial number or None),
+        # all USB serial ports by default; refresh=True ignores the cache.
+        if candidates is None:
+            candidates = self.candidates()
+        found = {}
+        unknown = []
+        for device, usb_serial in candidates:
+            role = None if refresh or not usb_serial else self.cache.get(usb_serial)
+            if role:
+                found[role] = device
+            else:
+                unknown.append((device, usb_serial))
+
+        if unknown:
+            with ThreadPoolExecutor(max_workers=len(unknown), thread_name_prefix="discovery") as pool:
+                identities = list(pool.map(self.handshake, [device for device, _ in unknown]))
+            for (device, usb_serial), identity in zip(unknown, identities):
+                if identity is None:
+                    continue
+                role, board_id = identity
+                if role in found:
+                    print(f"Error: {role} found on both {found[role]} and {device}, using {found[role]}")
+                    continue
+                found[role] = device
+                print(f"{device} is {role} (board {board_id})")
+                if usb_serial:
+                    self.cache[usb_serial] = role
+            self._save()
+
+        return found
@@ -0,0 +1,98 @@
+import json
+import math
+import threading
+from collections import deque
+from state_store import write_json_atomic
+
+def percentile(samples, fraction):
+    # Nearest-rank percentile
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+class DurationModel:
+    # Learns how long each board takes to acknowledge each command. Commands are kept
+    # apart by their full text and the ack awaited, so spool_up(60, 1) and
+    # spool_up(30, 1) are learned separately. Once a command has been seen often
+    # enough its deadline is the p99 times MARGIN, but never less than MIN_SLACK
+    # over the p99 and never more than the timeout the caller asked for.
+    SAMPLES = 100       # Most recent durations kept per command
+    MIN_SAMPLES = 10
+    MARGIN = 1.5
+    MIN_SLACK = 2.0     # Seconds
+    SAVE_EVERY = 20     # Samples between writes of the model file
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # Keeps an older snapshot from replacing a newer one
+        self._samples = {}  # (subsystem, command, ack) -> deque of seconds
+        self._unsaved = 0
+        self._saving = False
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        for entry in entries:
+            key = (entry["subsystem"], entry["command"], entry["ack"])
+            self._samples[key] = deque(entry["samples"], maxlen=self.SAMPLES)
+
+    def record(self, subsystem, command, ack, seconds):
+        key = (subsystem, command, ack)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.SAMPLES)
+            samples.append(round(seconds, 4))
+            self._unsaved += 1
+            save = self.path and self._unsaved >= self.SAVE_EVERY and not self._saving
+            if save:
+                self._saving = True
+        if save:
+            # record runs on the serial loop, which must not wait for the disk
+            threading.Thread(target=self._save_in_background, name="durations-save", daemon=True).start()
+
+    def deadline(self, subsystem, command, ack, timeout):
+        # Seconds after the command was sent by which its ack is overdue
+        with self._lock:
+            samples = self._samples.get((subsystem, command, ack))
+            if samples is None or len(samples) < self.MIN_SAMPLES:
+                return timeout
+            p99 = percentile(samples, 0.99)
+        return min(timeout, max(p99 * self.MARGIN, p99 + self.MIN_SLACK))
+
+    def summary(self):
+        with self._lock:
+            items = [(key, list(samples)) for key, samples in sorted(self._samples.items())]
+        return [{
+            "subsystem": subsystem,
+            "command": command,
+            "ack": ack,
+            "count": len(samples),
+            "p50": percentile(samples, 0.5),
+            "p99": percentile(samples, 0.99),
+            "learned": len(samples) >= self.MIN_SAMPLES,
+        } for (subsystem, command, ack), samples in items]
+
+    def save(self):
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                entries = [{"subsystem": subsystem, "command": command, "ack": ack, "samples": list(samples)}
+                           for (subsystem, command, ack), samples in self._samples.items()]
+                self._unsaved = 0
+            write_json_atomic(self.path, entries)
+
+    def _save_in_background(self):
+        try:
+            self.save()
+        except OSError as e:
+            print(f"Error: could not save durations to {self.path}: {e}")
+        finally:
+            with self._lock:
+                self._saving = False
@@ -0,0 +1,50 @@
+import json
+from gantry_controller import Beast
+from stations import Station, StationTable
+
+class Fleet:
+    # Every cell is a Beast with its own worker thread and state, all of them
+    # share the one serial loop thread that reads every port
+    def __init__(self):
+        self.cells = {}  # cell id -> Beast
+
+    @classmethod
+    def load(cls, path, **options):
+        # JSON {"cells": [{"id", "g_pico", "s_pico", "p_pico", "stations", "framed", "events", "state_path", "durations_path",
+        #                   "workflows_path"}]}
+        # where "stations" is an optional list in the same format as StationTable.load.
+        # options are Beast arguments every cell gets unless its entry sets them
+        with open(path) as f:
+            config = json.load(f)
+        fleet = cls()
+        for cell in config["cells"]:
+            cell = dict(cell)
+            cell_id = cell.pop("id")
+            stations = cell.pop("stations", None)
+            if stations is not None:
+                cell["stations"] = StationTable([Station(**entry) for entry in stations])
+            fleet.add(cell_id, Beast(cell_id=cell_id, **dict(options, **cell)))
+        return fleet
+
+    @property
+    def default(self):
+        # The first cell added, used by the routes that are not cell-scoped
+        return next(iter(self.cells.values()), None)
+
+    def add(self, cell_id, beast):
+        if cell_id in self.cells:
+            raise ValueError(f"Cell {cell_id} already exists")
+        self.cells[cell_id] = beast
+
+    def get(self, cell_id):
+        return self.cells.get(cell_id)
+
+    def status(self):
+        return {cell_id: beast.status() for cell_id, beast in self.cells.items()}
+
+    def health(self):
+        return {cell_id: beast.health() for cell_id, beast in self.cells.items()}
+
+    def close(self):
+        for beast in self.cells.values():
+            beast.close()
@@ -1,4 +1,7 @@
-from communication import Talker
+from acks import Ack, wait_for_ack
+from communication import SensorEvents, Talker
+from state_store import Persisted
+from stations import DockType, StationTable
 import time
 
 class GantryState:
@@ -19,19 +22,25 @@ class GantryPosition:
 
     @staticmethod
     def order():
-        return [
-            GantryPosition.HOME,
-            GantryPosition.STORAGE_1,
-            #GantryPosition.STORAGE_2,
-            GantryPosition.PRINTER_1,
-        ]
+        # Stations of the default layout, see stations.StationTable for others
+        return StationTable.default().names()
 
-class Gantry:
-    def __init__(self, talker: Talker):
+LOCKED_AND_LOADED = Ack("Locked and Loaded", negative=[r"^Intake empty$"])
+FILAMENT_OFF_SPOOL = Ack("Filament off spool.", progress=[r"^Tension off\.$"])
+
+class Gantry(SensorEvents, Persisted):
+    PERSISTED = ("position", "docked", "state")
+
+    def __init__(self, talker: Talker, stations: StationTable = None):
         self.position = GantryPosition.UNKNOWN
         self.docked = False
         self.state = GantryState.WAIT
         self.talker = talker
+        self.stations = stations or StationTable.default()
+
+    def _dock_type(self):
+        station = self.stations.get(self.position)
+        return station.dock_type if station else DockType.NONE
 
     def home(self):
         if self.docked:
@@ -45,7 +54,7 @@ class Gantry:
             self.talker.send(command)
             print("Moving to home...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Home Success")
+            complete = wait_for_ack(self.talker, "Home Success")
             if complete:
                 self.position = GantryPosition.HOME
                 self.state = GantryState.WAIT
@@ -71,32 +80,23 @@ class Gantry:
             self.state = GantryState.ERROR
             return False
         
-        positions = GantryPosition.order()
-        
-        if target_position not in positions:
+        if target_position not in self.stations:
             print(f"Invalid target position: {target_position}")
             self.state = GantryState.ERROR
             return False
 
-        current_index = positions.index(self.position)
-        target_index = positions.index(target_position)
-
-        if current_index < target_index:
-            steps = target_index - current_index
-            command = f"move_left({steps})"
-        elif current_index > target_index:
-            steps = current_index - target_index
-            command = f"move_right({steps})"
-        else:
+        command, steps = self.stations.plan(self.position, target_position)
+        if command is None:
             print("Already at the target position.")
             return True
 
         self.state = GantryState.MOVING
         try:
             self.talker.send(command)
-            print(f"Moving {steps} step(s) {'left' if current_index < target_index else 'right'} to {target_position}...")
+            print(f"Moving {steps} step(s) {'left' if command.startswith('move_left') else 'right'} to {target_position}"
+                  f" ({self.stations.distance(self.position, target_position)}mm)...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Movement Successful")
+            complete = wait_for_ack(self.talker, "Movement Successful")
             if complete:
                 self.position = target_position
                 self.state = GantryState.WAIT
@@ -112,13 +112,13 @@ class Gantry:
             return False
 
     def dock(self):
-        if self.position in [GantryPosition.STORAGE_1, GantryPosition.PRINTER_1]:
+        if self._dock_type() != DockType.NONE:
             try:
                 command = "dock()"
                 self.talker.send(command)
                 print("Docking...")
                 time.sleep(0.1)
-                complete = self._wait_for_ack("Dock successful.")
+                complete = wait_for_ack(self.talker, "Dock successful.")
                 if complete:
                     self.docked = True
                     print("Dock Successful")
@@ -142,7 +142,7 @@ class Gantry:
             self.talker.send(command)
             print("Undocking...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Undock successful.")
+            complete = wait_for_ack(self.talker, "Undock successful.")
             if complete:
                 self.docked = False
                 print("Undock Successful")
@@ -162,7 +162,7 @@ class Gantry:
             self.talker.send(command)
             print("Checking intake...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Locked and Loaded", 0.1)
+            complete = wait_for_ack(self.talker, LOCKED_AND_LOADED, 0.1)
             if complete:
                 print("Intake check successful.")
                 return True
@@ -173,14 +173,20 @@ class Gantry:
             self.state = GantryState.ERROR
             return False
 
+    def wait_for_intake_event(self, since, timeout=120):
+        if super().wait_for_intake_event(since, timeout):
+            return True
+        self.state = GantryState.ERROR
+        return False
+
     def intake(self):
-        if self.docked and self.position == GantryPosition.STORAGE_1:
+        if self.docked and self._dock_type() == DockType.STORAGE:
             try:
                 command = "intake_filament()"
                 self.talker.send(command)
                 print("Intaking material...")
                 time.sleep(0.1)
-                complete = self._wait_for_ack("Intake successful.", 360)
+                complete = wait_for_ack(self.talker, "Intake successful.", 360)
                 if complete:
                     print("Intake Successful")
                     self.state = GantryState.INTAKE
@@ -200,6 +206,11 @@ class Gantry:
             self.state = GantryState.ERROR
             return False
 
+    def intake_and_spool(self, spool_time, speed):
+        # Each step is confirmed before the next is sent: intake_filament() prints
+        # "Intake empty" instead of raising, so a batched spool_up() would still run
+        return self.intake() and self.spool(spool_time, speed)
+
     def spool_until(self, speed):
         if self.state == GantryState.INTAKE:
             try:
@@ -207,7 +218,7 @@ class Gantry:
                 self.talker.send(command)
                 print("Spooling material...")
                 time.sleep(0.1)
-                complete = self._wait_for_ack("**Full Speed Phase**")
+                complete = wait_for_ack(self.talker, "**Full Speed Phase**")
                 if complete:
                     print("Spooling")
                     self.state = GantryState.SPOOLING
@@ -232,7 +243,7 @@ class Gantry:
                 self.talker.send(command)
                 print("Spooling material...")
                 time.sleep(0.1)
-                complete = self._wait_for_ack("Spool successful.", 360)
+                complete = wait_for_ack(self.talker, "Spool successful.", 360)
                 if complete:
                     print("Spool Successful")
                     self.state = GantryState.SPOOLING
@@ -256,7 +267,7 @@ class Gantry:
             self.talker.send(command)
             print("Delivering filament...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament delivery started")
+            complete = wait_for_ack(self.talker, "Filament delivery started")
             if complete:
                 self.state = GantryState.DELIVER
                 print("Filament delivery started successfully")
@@ -276,7 +287,7 @@ class Gantry:
             self.talker.send(command)
             print("Delivering {length}mm of filament...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament delivered successfully.")
+            complete = wait_for_ack(self.talker, "Filament delivered successfully.")
             if complete:
                 self.state = GantryState.DELIVER
                 print("Filament delivery started successfully")
@@ -298,7 +309,7 @@ class Gantry:
                 self.talker.send(command)
                 print("Retreiving filament...")
                 time.sleep(0.1)
-                complete = self._wait_for_ack("Filament retrieved.", 240)
+                complete = wait_for_ack(self.talker, "Filament retrieved.", 240)
                 if complete:
                     print("Retrieve Successful")
                     return True
@@ -322,7 +333,7 @@ class Gantry:
                 self.talker.send(command)
                 print("Unspooling material...")
                 time.sleep(0.1)
-                complete = self._wait_for_ack("Unspool successful.")
+                complete = wait_for_ack(self.talker, "Unspool successful.")
                 if complete:
                     self.state = GantryState.UNSPOOL
                     print("Unspool Successful")
@@ -348,12 +359,12 @@ class Gantry:
                 print("Revieving motor tension material...")
                 if not interrupt:
                     time.sleep(0.1)
-                    complete = self._wait_for_ack("Tension off.")
+                    complete = wait_for_ack(self.talker, "Tension off.")
                     if complete:
                         print("Tension off Successful")
                 else:
                     time.sleep(0.1)
-                    complete = self._wait_for_ack("Filament off spool.", 3000)
+                    complete = wait_for_ack(self.talker, FILAMENT_OFF_SPOOL, 3000)
                     if complete:
                         self.state = GantryState.UNSPOOL
                         print("Spool off")
@@ -377,21 +388,21 @@ class Gantry:
             self.talker.send_blind("STOP")
             print("Stopping...")
             time.sleep(0.1)
-            complete = self._wait_for_ack(f"{success_message}", 5)
+            complete = wait_for_ack(self.talker, f"{success_message}", 5)
             if complete:
                 print("Delivery Stopped")
                 return True
             self.talker.send("STOP")
             time.sleep(0.1)
             print("Stopping...")
-            complete = self._wait_for_ack(f"{success_message}", 10)
+            complete = wait_for_ack(self.talker, f"{success_message}", 10)
             if complete:
                 print("Delivery Stopped")
                 return True
             self.talker.send("STOP")
             time.sleep(0.1)
             print("Stopping...")
-            complete = self._wait_for_ack(f"{success_message}", 15)
+            complete = wait_for_ack(self.talker, f"{success_message}", 15)
             if complete:
                 print("Action Stopped")
                 return True
@@ -400,31 +411,8 @@ class Gantry:
             return False
         
     def wait_for_input(self, message, timeout=30):
-        start_time = time.time()
-        while True:
-            reply = self.talker.receive()
-            print(f"Received: {reply}")
-            if reply == message:
-                print(message)
-                return True
-
-            if time.time() - start_time > timeout:
-                print(f"{message} not received before timeout of {timeout}")
-                return False
-
-    def _wait_for_ack(self, success_message, timeout=30):
-        start_time = time.time()
-        partial_message = success_message[1:]  # Get message without first letter
-        
-        while True:
-            reply = self.talker.receive()
-            print(f"Received: {reply}")
-            
-            if reply == success_message or reply == partial_message:
-                print(success_message)
-                return True
-                
-            # Check if the timeout has been exceeded
-            if time.time() - start_time > timeout:
-                print("Operation timed out.")
-                return False
+        if self.talker.wait_for(message, timeout):
+            print(message)
+            return True
+        print(f"{message} not received before timeout of {timeout}")
+        return False
@@ -1,8 +1,17 @@
+import asyncio
 import time
-from communication import Talker
-from gantry import Gantry
+from concurrent.futures import ThreadPoolExecutor
+from communication import LazyTalker, Talker, last_failure
+from discovery import PortDiscovery
+from durations import DurationModel
+from gantry import Gantry, GantryState
 from storage import FilamentHandler, FilamentSlot
 from printer_spool import printerSpool
+from recorder import TrafficRecorder
+from state_store import StateStore
+from telemetry import TELEMETRY
+from stations import DockType, Station, StationTable
+from workflows import Step, Workflow, cancelled, load_workflows, resumable
 
 # Define custom exception
 class ActionError(Exception):
@@ -10,116 +19,438 @@ class ActionError(Exception):
 
 def check_action(success, action_name):
     if not success:
-        raise ActionError(f"Error: Expected \"{action_name}\" but action failed")
+        # The board's error or the timeout of the wait that failed, when there was one
+        reason = last_failure()
+        raise ActionError(f"Error: Expected \"{action_name}\" but action failed" + (f": {reason}" if reason else ""))
+
+# The loads as workflows, see workflows.py. Steps on different boards that do not
+# depend on each other run at the same time.
+LOAD_GANTRY = Workflow("load_gantry", [
+    Step("feed", ["storage", "gantry"], "feed_gantry", timeout=300, compensate="storage_stop"),
+    Step("extrude", "storage", "storage_extrude", [80]),
+    Step("intake_and_spool", "gantry", "gantry_intake_and_spool", ["$amount_secs", "$speed"]),
+    Step("cut", "storage", "storage_cut"),
+    # The storage pulls its end back while the gantry retrieves the cut piece
+    Step("pull_out", "storage", "storage_pull_out", after=["cut"]),
+    Step("retreive_filament", "gantry", "gantry_retreive", after=["cut"]),
+    Step("undock", "storage", "storage_undock", after=["pull_out", "retreive_filament"]),
+], {"amount_secs": 60, "speed": 1})
+
+LOAD_PRINTER = Workflow("load_printer", [
+    Step("feed", ["gantry", "printer"], "feed_printer", timeout=300, compensate="gantry_stop_delivery"),
+    Step("deliver_filament", "gantry", "gantry_deliver", [20]),
+    Step("intake_filament", "printer", "printer_intake"),
+    # The printer ramps up while the gantry releases its motor tension
+    Step("release_tension", "gantry", "gantry_release_tension", after=["intake_filament"]),
+    Step("spool_up_until", "printer", "printer_spool_up_until", [1], after=["intake_filament"],
+         compensate="printer_stop", until="stop_spool"),
+    Step("unspool", "gantry", "gantry_unspool", after=["release_tension", "spool_up_until"]),
+    Step("stop_spool", "printer", "printer_stop"),
+])
+
+# Milliseconds since the board booted, answered by MicroPython without touching the motors
+UPTIME_PROBE = "__import__('time').ticks_ms()"
 
 class Beast:
-    def __init__(self, g_pico = '/dev/ttyACM0', s_pico = "/dev/ttyACM1", p_pico = "/dev/ttyACM3"):
-        gantryPico = Talker(g_pico, timeout=1)
-        storagePico = Talker(s_pico, timeout=1)
-        printerPico = Talker(p_pico, timeout=1)
+    STAGING_AMOUNT = 40  # Filament pre-advanced in pipelined loads
+    BOOT_TOLERANCE = 2.0  # Seconds two uptime probes of the same boot may disagree by
+
+    def __init__(self, g_pico = '/dev/ttyACM0', s_pico = "/dev/ttyACM1", p_pico = "/dev/ttyACM3", framed = False, events = False,
+                 stations = None, cell_id = None, state_path = None, lazy = False, record_path = None,
+                 durations_path = None, workflows_path = None):
+        # framed=True needs board firmware that answers "@<id> <command>" lines with tagged replies
+        # stations is a StationTable, s_pico and p_pico are the ports of storage_1 and printer_1
+        # cell_id names this microfactory cell when a Fleet runs several of them
+        # state_path is a JSON file the board states are saved to, so a restart can skip homing
+        # lazy=True returns at once and opens the ports in the background, see health()
+        # record_path is a capture file all serial traffic is logged to, see recorder.py
+        # durations_path keeps the learned command durations across restarts, see durations.py
+        # workflows_path is a JSON file of workflows that add to or replace the built-in loads
+        self.cell_id = cell_id
+        self.stations = stations or StationTable.default()
+        ports = {"storage_1": s_pico, "printer_1": p_pico}
+        prefix = f"{cell_id}." if cell_id else ""
+        open_port = LazyTalker if lazy else Talker
+        self.recorder = TrafficRecorder(record_path) if record_path else None
+        self.durations = DurationModel(durations_path)
+
+        gantryPico = open_port(g_pico, timeout=1, name=f"{prefix}gantry", framed=framed, recorder=self.recorder,
+                               on_line=self._publish_line("gantry"), durations=self.durations)
+        self.gantryState = Gantry(gantryPico, self.stations)
+
+        # One board per docking station, keyed by station name
+        self.docks = {}
+        for station in self.stations:
+            if station.dock_type == DockType.NONE:
+                continue
+            port = station.port or ports.get(station.name)
+            if port is None:
+                raise ValueError(f"No serial port configured for station {station.name}")
+            talker = open_port(port, timeout=1, name=f"{prefix}{station.name}", framed=framed, recorder=self.recorder,
+                               on_line=self._publish_line(station.name), durations=self.durations)
+            if station.dock_type == DockType.STORAGE:
+                self.docks[station.name] = FilamentHandler(talker)
+            else:
+                self.docks[station.name] = printerSpool(talker)
 
-        self.gantryState = Gantry(gantryPico)
-        self.storageState = FilamentHandler(storagePico)
-        self.printerSpoolState = printerSpool(printerPico)
+        # The storage unit and printer the loads work with, move_gantry_to switches them
+        self.storageState = self.docks[self.stations.of_type(DockType.STORAGE)[0].name]
+        self.printerSpoolState = self.docks[self.stations.of_type(DockType.PRINTER)[0].name]
 
         self.activeSlot = FilamentSlot.ONE
 
+        # events=True waits on sensor edges pushed by the boards instead of polling them
+        self.events = events
+
+        # Single worker so workflows never interleave on the boards
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"beast-{cell_id or 'default'}")
+        # One worker per board for steps that can run side by side
+        self._board_pool = ThreadPoolExecutor(max_workers=len(self.docks) + 1, thread_name_prefix="board")
+
+        self.store = StateStore(state_path) if state_path else None
+        self.restored = False
+        self.workflows = {workflow.name: workflow for workflow in (LOAD_GANTRY, LOAD_PRINTER)}
+        if workflows_path:
+            self.workflows.update((workflow.name, workflow) for workflow in load_workflows(workflows_path))
+        # Progress of the last workflow, see resume()
+        self.checkpoint = (self.store.get("workflow") if self.store else None) or None
+        self._gantry_checkpoint = None
+        for key, subsystem in self._boards():
+            subsystem.watch(self._publish_state(key))
+
+        # Each board is set up as soon as its port is open
+        if lazy:
+            for key, subsystem in self._boards():
+                subsystem.talker.start(lambda key=key, subsystem=subsystem: self._setup_board(key, subsystem))
+        else:
+            self.run_concurrently(*[(lambda key=key, subsystem=subsystem: self._setup_board(key, subsystem), f"{key} setup")
+                                    for key, subsystem in self._boards()])
+
+    @classmethod
+    def discover(cls, cache_path = None, candidates = None, stations = None, **kwargs):
+        # Build a Beast on whichever ports the boards identify themselves on,
+        # every docking station's board must report that station's name as its role
+        stations = stations or StationTable.default()
+        ports = PortDiscovery(cache_path).discover(candidates)
+        if "gantry" not in ports:
+            raise ValueError("Gantry board not found")
+        stations = StationTable([
+            Station(station.name, station.offset, station.dock_type, ports.get(station.name, station.port))
+            for station in stations])
+        return cls(g_pico=ports["gantry"], s_pico=None, p_pico=None, stations=stations, **kwargs)
+
+    @property
+    def talkers(self):
+        return [self.gantryState.talker] + [dock.talker for dock in self.docks.values()]
+
+    def run_concurrently(self, *actions):
+        # Each action is a (callable, action_name) pair for a different board.
+        # Waits for all of them and raises one ActionError listing every failure.
+        futures = [(self._board_pool.submit(action), action_name) for action, action_name in actions]
+        errors = []
+        for future, action_name in futures:
+            try:
+                success = future.result()
+            except Exception as e:
+                errors.append(f"\"{action_name}\" raised {e}")
+                continue
+            if not success:
+                errors.append(f"Expected \"{action_name}\" but action failed")
+        if errors:
+            raise ActionError("Error: " + "; ".join(errors))
+
+    def _boards(self):
+        # (store key, subsystem) for every board
+        return [("gantry", self.gantryState)] + list(self.docks.items())
+
+    def _probe_boot_time(self, subsystem):
+        reply = subsystem.talker.query(UPTIME_PROBE)
+        try:
+            return time.time() - int(reply) / 1000
+        except (TypeError, ValueError):
+            return None
+
+    def _setup_board(self, key, subsystem):
+        if self.events and (key == "gantry" or self.stations.get(key).dock_type == DockType.PRINTER):
+            success = subsystem.subscribe_events()
+            check_action(success, "subscribe_events()")
+        if self.store is not None:
+            self._restore_board(key, subsystem)
+        return True
+
+    def _restore_board(self, key, subsystem):
+        # Resume the saved state when the board has not rebooted since it was written,
+        # otherwise it starts afresh and an unknown gantry position homes on the first move.
+        # ticks_ms wraps after about 12 days, which reads as a reboot.
+        boot = self._probe_boot_time(subsystem)
+        saved = self.store.get(key)
+        resume = (boot is not None and saved.get("boot_time") is not None
+                  and abs(boot - saved["boot_time"]) < self.BOOT_TOLERANCE)
+        # A move that never finished leaves the gantry somewhere between stations
+        if key == "gantry" and saved.get("state") == GantryState.MOVING:
+            resume = False
+        if resume:
+            subsystem.restore(saved)
+        subsystem.attach_store(self.store, key)
+        self.store.update(key, {"boot_time": boot})
+        if not resume:
+            print(f"Saved state of {key} not resumable")
+            return False
+
+        if key == "gantry":
+            position = self.gantryState.position
+            if self.gantryState.docked and position in self.docks:
+                if self.stations.get(position).dock_type == DockType.STORAGE:
+                    self.storageState = self.docks[position]
+                else:
+                    self.printerSpoolState = self.docks[position]
+            self.restored = True
+        if self.storageState.active_slot:
+            self.activeSlot = self.storageState.active_slot
+        print(f"Resumed {key} from saved state")
+        return True
+
+    def _publish_line(self, key):
+        def publish(line):
+            TELEMETRY.publish({"type": "log", "cell": self.cell_id, "subsystem": key, "line": line})
+        return publish
+
+    def _publish_state(self, key):
+        def publish(name, value):
+            TELEMETRY.publish({"type": "state", "cell": self.cell_id, "subsystem": key, "field": name, "value": value})
+        return publish
+
+    def health(self):
+        # Readiness of every board without waiting for any of them
+        boards = {}
+        for key, subsystem in self._boards():
+            talker = subsystem.talker
+            boards[key] = {"port": talker.port, "ready": talker.ready, "error": talker.error}
+        return {"ready": all(board["ready"] for board in boards.values()), "boards": boards}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._board_pool.shutdown(wait=True)
+        for talker in self.talkers:
+            talker.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.durations.save()
+
+    def submit(self, action, *args):
+        # Queue an action on the Beast worker, returns a concurrent.futures.Future
+        return self._executor.submit(action, *args)
+
+    @property
+    def current_step(self):
+        # The most recent command sent to any of the boards
+        latest = max(self.talkers, key=lambda talker: talker.last_command_time)
+        return latest.last_command
+
+    async def _run_async(self, action, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, action, *args)
+
+    async def home_state_async(self):
+        await self._run_async(self.home_state)
+
+    async def move_gantry_to_async(self, location):
+        await self._run_async(self.move_gantry_to, location)
+
+    async def change_active_slot_async(self):
+        await self._run_async(self.change_active_slot)
+
+    def status(self):
+        return {
+            "position": self.gantryState.position,
+            "docked": self.gantryState.docked,
+            "gantry_state": self.gantryState.state,
+            "storage_state": self.storageState.state,
+            "active_slot": self.activeSlot,
+            "restored": self.restored,
+            "workflow": self.checkpoint,
+        }
+
     def home_state(self):
         home_state = False
         while not home_state:
-            success = self.storageState.undock()
-            check_action(success, 'undock()')
-            success = self.printerSpoolState.undock()
-            check_action(success, 'undock()')
+            # Every docking station is a separate board, undock them all at once
+            self.run_concurrently(*[(dock.undock, f"{name} undock()") for name, dock in self.docks.items()])
             self.gantryState.docked = False
             success = self.gantryState.home()
             check_action(success, "home()")
             home_state = True
 
     def move_gantry_to(self, location):
-        while True:
-            success = self.gantryState.move_to(location)
-            check_action(success, f"move_to({location})")
-            if location == "storage_1":
-                success = self.storageState.dock()
-                check_action(success, "dock()")
-                self.gantryState.position = "storage_1"
-                self.gantryState.docked = True
-                return
-            elif location == "printer_1":
-                success = self.printerSpoolState.dock()
-                check_action(success, "dock()")
-                self.gantryState.position = "printer_1"
-                self.gantryState.docked = True
-                return
-            else:
-                raise ActionError(f"Error: \"{location}\" not a valid location")
+        station = self.stations.get(location)
+        if station is None:
+            raise ActionError(f"Error: \"{location}\" not a valid location")
+        success = self.gantryState.move_to(location)
+        check_action(success, f"move_to({location})")
+        if station.dock_type != DockType.NONE:
+            self._dock_at(location)
+
+    def _dock_at(self, location):
+        dock = self.docks[location]
+        success = dock.dock()
+        check_action(success, "dock()")
+        if self.stations.get(location).dock_type == DockType.STORAGE:
+            self.storageState = dock
+        else:
+            self.printerSpoolState = dock
+        self.gantryState.position = location
+        self.gantryState.docked = True
+
+    def undock(self):
+        # Release the gantry from the station it is docked at
+        if not self.gantryState.docked:
+            return
+        dock = self.docks.get(self.gantryState.position)
+        if dock is not None:
+            success = dock.undock()
+            check_action(success, "undock()")
+        self.gantryState.docked = False
 
     def change_active_slot(self):
         self.storageState.change_slot(self.activeSlot)
 
     def load_gantry_with_filament(self, amount_secs = 60, speed = 1):
+        self.run_workflow("load_gantry", amount_secs=amount_secs, speed=speed)
+
+    def _feed_gantry(self):
         # Deliver filament until intake is detected
+        since = self.gantryState.talker.mark()
         success = self.storageState.deliver_filament()
         check_action(success, "deliver_filament()")
+        # Any staged filament is part of this delivery, so the slot is no longer staged
+        self.storageState.state = "idle"
 
-        while not self.gantryState.check_intake():
-            time.sleep(0.1)
+        if self.events:
+            success = self.gantryState.wait_for_intake_event(since)
+            check_action(success, "intake event")
+        else:
+            while not self.gantryState.check_intake():
+                if cancelled():
+                    raise ActionError("Error: Waiting for the gantry intake cancelled")
+                time.sleep(0.1)
         # Stop storage action
         success = self.storageState.stop()
         check_action(success, "stop()")
 
-        success = self.storageState.extruder(80)
-        check_action(success, "extruder(10)")
-
-        success = self.gantryState.intake()
-        check_action(success, "intake()")
-
-        success = self.gantryState.spool(amount_secs, speed)
-        check_action(success, "spool()")
-
-        success = self.storageState.cut_filament()
-        check_action(success, "cut_filament()")
-
-        success = self.storageState.pull_out()
-        check_action(success, "pull_out()")
-
-        success = self.gantryState.retreiveFilament()
-        check_action(success, "retreiveFilament()")
-
+    def _undock_storage(self):
         success = self.storageState.undock()
         check_action(success, "undock()")
-        if success:
-            self.gantryState.docked = False
+        self.gantryState.docked = False
+
 
+    def load_gantry_pipelined(self, amount_secs = 60, speed = 1, staging_amount = None, location = None):
+        # Stage filament on the active slot while the gantry travels to storage,
+        # then dock and finish the regular load from the staged position. location
+        # defaults to the storage unit nearest the gantry.
+        if staging_amount is None:
+            staging_amount = self.STAGING_AMOUNT
+        if location is None:
+            storages = [station.name for station in self.stations.of_type(DockType.STORAGE)]
+            location = self.stations.nearest(self.gantryState.position, storages)
+        station = self.stations.get(location)
+        if station is None or station.dock_type != DockType.STORAGE:
+            raise ActionError(f"Error: \"{location}\" is not a storage station")
+        storage = self.docks[location]
+        # A docked gantry cannot move, and staging must not start for a gantry that never arrives
+        self.undock()
+        self.run_concurrently(
+            (lambda: self.gantryState.move_to(location), f"move_to({location})"),
+            (lambda: storage.stage_filament(staging_amount), f"stage_filament({staging_amount})"),
+        )
+        self._dock_at(location)
+
+        self.load_gantry_with_filament(amount_secs, speed)
 
     def load_printer_with_filament(self):
+        self.run_workflow("load_printer")
+
+    def _feed_printer(self):
         # Deliver filament until intake is detected
+        since = self.printerSpoolState.talker.mark()
         success = self.gantryState.deliver_filament_until()
         check_action(success, "deliver_filament()")
         self.gantryState.talker.send_blind("Proceed")
 
-        while not self.printerSpoolState.wait_for_intake():
-            time.sleep(0.1)
-            self.gantryState.talker.send_blind("Proceed")
+        if self.events:
+            # Subscribed boards keep delivering after one "Proceed"
+            success = self.printerSpoolState.wait_for_intake_event(since)
+            check_action(success, "intake event")
+        else:
+            while not self.printerSpoolState.wait_for_intake():
+                if cancelled():
+                    raise ActionError("Error: Waiting for the printer intake cancelled")
+                time.sleep(0.1)
+                self.gantryState.talker.send_blind("Proceed")
         # Stop storage action
         success = self.gantryState.stop("Filament delivery stopped")
         check_action(success, "stop()")
 
-        success = self.gantryState.deliver_filament(20)
-        check_action(success, "deliver_filament()")
+    def _actions(self):
+        # What workflow steps can do, see workflows.py. The storage unit and printer
+        # are looked up when a step runs, since moving the gantry switches them.
+        return {
+            "feed_gantry": self._feed_gantry,
+            "feed_printer": self._feed_printer,
+            "storage_extrude": lambda amount: self.storageState.extruder(amount),
+            "storage_cut": lambda: self.storageState.cut_filament(),
+            "storage_pull_out": lambda: self.storageState.pull_out(),
+            "storage_stop": lambda: self.storageState.stop(),
+            "storage_undock": self._undock_storage,
+            "gantry_intake_and_spool": lambda spool_time, speed: self.gantryState.intake_and_spool(spool_time, speed),
+            "gantry_retreive": lambda: self.gantryState.retreiveFilament(),
+            "gantry_deliver": lambda length: self.gantryState.deliver_filament(length),
+            "gantry_stop_delivery": lambda: self.gantryState.stop("Filament delivery stopped"),
+            "gantry_release_tension": lambda: self.gantryState.unspoolTension(),
+            "gantry_unspool": lambda: self.gantryState.unspoolTension(True),
+            "printer_intake": lambda: self.printerSpoolState.intake_filament(),
+            "printer_spool_up_until": lambda speed: self.printerSpoolState.spool_up_until(speed),
+            "printer_stop": lambda: self.printerSpoolState.stop(),
+        }
 
-        success = self.printerSpoolState.intake_filament()
-        check_action(success, "intake_filament()")
+    def run_workflow(self, name, **args):
+        workflow = self.workflows.get(name)
+        if workflow is None:
+            raise ActionError(f"Error: \"{name}\" not a known workflow")
+        self._run_workflow(workflow, args)
 
-        success = self.gantryState.unspoolTension()
-        check_action(success, "unspoolTension()")
+    def _run_workflow(self, workflow, args, checkpoint = None):
+        self._gantry_checkpoint = self._gantry_snapshot()
+        workflow.run(self._actions(), args, self._board_pool, self._save_checkpoint, checkpoint, last_failure)
 
-        success = self.printerSpoolState.spool_up_until(1)
-        check_action(success, "spool_up_until(1)")
+    def _gantry_snapshot(self):
+        return {"state": self.gantryState.state, "position": self.gantryState.position,
+                "docked": self.gantryState.docked}
 
-        success = self.gantryState.unspoolTension(True)
-        check_action(success, "unspoolTension(True)")
-        # Stop storage action
-        success = self.printerSpoolState.stop("Spool operation complete.")
-        check_action(success, "stop()")
+    def _save_checkpoint(self, checkpoint, succeeded, step):
+        # The gantry as the last gantry step that succeeded left it, resume() puts its
+        # state back. A step on another board that succeeds while a gantry step fails
+        # beside it must not record the failed gantry.
+        if succeeded and (step is None or "gantry" in step.boards):
+            self._gantry_checkpoint = self._gantry_snapshot()
+        checkpoint["gantry"] = self._gantry_checkpoint
+        self.checkpoint = checkpoint
+        if self.store is not None:
+            self.store.update("workflow", checkpoint)
+        TELEMETRY.publish({"type": "checkpoint", "cell": self.cell_id, "checkpoint": checkpoint})
+
+    def resume(self):
+        # Run the steps of the last workflow that did not succeed, or were running when
+        # the process stopped, once the operator has cleared the fault
+        checkpoint = self.checkpoint
+        if not resumable(checkpoint):
+            raise ActionError("Error: No stopped workflow to resume")
+        workflow = self.workflows.get(checkpoint["workflow"])
+        if workflow is None:
+            raise ActionError(f"Error: \"{checkpoint['workflow']}\" not a known workflow")
+        gantry = checkpoint.get("gantry") or {}
+        if (gantry.get("position"), gantry.get("docked")) != (self.gantryState.position, self.gantryState.docked):
+            raise ActionError(f"Error: Gantry moved since \"{checkpoint['workflow']}\" stopped, start it again instead")
+        self.gantryState.state = gantry["state"]
+        remaining = [name for name in workflow.names() if name not in checkpoint["done"]]
+        print(f"Resuming {workflow.name} with {', '.join(remaining)}")
+        self._run_workflow(workflow, checkpoint["args"], checkpoint)
@@ -0,0 +1,100 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+class JobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+class Job:
+    def __init__(self, name, beast):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.beast = beast
+        self.status = JobStatus.QUEUED
+        self.step = None
+        self.checkpoint = None  # The Beast's workflow checkpoint when the job started
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def current_step(self):
+        # A job that runs a workflow reports step names: those running, or once it has
+        # stopped those that failed, else the last that succeeded. Other jobs, and
+        # workflows between steps, report the last command sent to a board.
+        checkpoint = self.beast.checkpoint
+        if checkpoint is None or checkpoint is self.checkpoint:
+            return self.beast.current_step
+        if checkpoint["finished"] is None:
+            return ", ".join(checkpoint["running"]) or self.beast.current_step
+        if checkpoint["failed"]:
+            return ", ".join(checkpoint["failed"])
+        return checkpoint["done"][-1] if checkpoint["done"] else self.beast.current_step
+
+    def to_dict(self):
+        step = self.step
+        if self.status == JobStatus.RUNNING:
+            step = self.current_step()
+        if self.started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.finished or time.time()) - self.started
+        return {
+            "id": self.id,
+            "name": self.name,
+            "cell": self.beast.cell_id,
+            "status": self.status,
+            "step": step,
+            "created": self.created,
+            "elapsed_secs": round(elapsed, 3),
+            "result": self.result,
+            "error": self.error,
+        }
+
+class JobManager:
+    def __init__(self, max_finished=200):
+        self.max_finished = max_finished
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, beast, name, message, action, *args):
+        # Jobs run on the Beast worker, one at a time and in submission order
+        job = Job(name, beast)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        beast.submit(self._run, job, message, action, *args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job, message, action, *args):
+        job.checkpoint = job.beast.checkpoint
+        job.status = JobStatus.RUNNING
+        job.started = time.time()
+        try:
+            action(*args)
+            job.result = {"message": message}
+            job.status = JobStatus.SUCCEEDED
+        except Exception as e:
+            job.error = str(e)
+            job.status = JobStatus.FAILED
+        finally:
+            job.step = job.current_step()
+            job.finished = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
@@ -0,0 +1,97 @@
+import bisect
+import re
+import threading
+
+COMMAND_NAME = re.compile(r"^\s*(?:[A-Za-z_]\w*\.)?([A-Za-z_]\w*)")
+
+def command_name(text):
+    # "stepper_TL.deliver_filament(80)" -> "deliver_filament", "STOP" -> "STOP"
+    match = COMMAND_NAME.match(text or "")
+    return match.group(1) if match else "unknown"
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.echo = {}      # (subsystem, command) -> Histogram of send to echo
+        self.ack = {}       # (subsystem, command) -> Histogram of send to acknowledgement
+        self.timeouts = {}  # (subsystem, command) -> acknowledgements never received
+        self.retries = {}   # (subsystem, command) -> commands re-sent after a timeout
+        self.stalls = {}    # (subsystem, command) -> waits cut short by a learned deadline
+        self.failures = {}  # (subsystem, command) -> errors reported by the board instead of an ack
+
+    def observe_echo(self, subsystem, command, seconds):
+        self._observe(self.echo, subsystem, command, seconds)
+
+    def observe_ack(self, subsystem, command, seconds):
+        self._observe(self.ack, subsystem, command, seconds)
+
+    def count_timeout(self, subsystem, command):
+        self._count(self.timeouts, subsystem, command)
+
+    def count_retry(self, subsystem, command):
+        self._count(self.retries, subsystem, command)
+
+    def count_stall(self, subsystem, command):
+        self._count(self.stalls, subsystem, command)
+
+    def count_failure(self, subsystem, command):
+        self._count(self.failures, subsystem, command)
+
+    def _observe(self, histograms, subsystem, command, seconds):
+        key = (subsystem, command_name(command))
+        with self._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def _count(self, counters, subsystem, command):
+        key = (subsystem, command_name(command))
+        with self._lock:
+            counters[key] = counters.get(key, 0) + 1
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            for metric, histograms, description in [
+                ("amf_command_echo_seconds", self.echo, "Time from sending a command to its REPL echo."),
+                ("amf_command_ack_seconds", self.ack, "Time from sending a command to its acknowledgement."),
+            ]:
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} histogram")
+                for (subsystem, command), histogram in sorted(histograms.items()):
+                    labels = f'subsystem="{subsystem}",command="{command}"'
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f"{metric}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+            for metric, counters, description in [
+                ("amf_command_timeouts_total", self.timeouts, "Acknowledgements that timed out."),
+                ("amf_command_retries_total", self.retries, "Commands re-sent after a timed out acknowledgement."),
+                ("amf_command_stalls_total", self.stalls, "Acknowledgements overdue against the learned duration."),
+                ("amf_command_failures_total", self.failures, "Errors and tracebacks reported instead of an acknowledgement."),
+            ]:
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} counter")
+                for (subsystem, command), count in sorted(counters.items()):
+                    lines.append(f'{metric}{{subsystem="{subsystem}",command="{command}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
@@ -1,9 +1,64 @@
-from fastapi import FastAPI, HTTPException
+import os
+import threading
+from typing import Any, Dict, Optional
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from fleet import Fleet
 from gantry_controller import Beast
+from jobs import JobManager
+from metrics import METRICS
+from scheduler import LoadScheduler
+from stations import StationTable
+from storage import FilamentSlot
+from telemetry import TELEMETRY, server_sent_event
 
 app = FastAPI()
-beast = Beast()
+router = APIRouter()
+# Ports open in the background so the server starts without waiting for the boards
+if os.environ.get("AMF_CELLS"):
+    # AMF_CELLS points at a JSON fleet config with one entry per microfactory cell
+    fleet = Fleet.load(os.environ["AMF_CELLS"], lazy=True)
+else:
+    # AMF_STATIONS points at a JSON station table for layouts beyond one storage unit and printer
+    stations = StationTable.load(os.environ["AMF_STATIONS"]) if os.environ.get("AMF_STATIONS") else None
+    fleet = Fleet()
+    # AMF_STATE points at the file the board states are saved to, so restarts can skip homing
+    # AMF_RECORD points at a capture file every byte to and from the boards is logged to
+    # AMF_DURATIONS points at the file the learned command durations are kept in
+    # AMF_WORKFLOWS points at a JSON file of workflows added to the built-in loads
+    options = {"stations": stations, "cell_id": "default", "state_path": os.environ.get("AMF_STATE"),
+               "record_path": os.environ.get("AMF_RECORD"), "durations_path": os.environ.get("AMF_DURATIONS"),
+               "workflows_path": os.environ.get("AMF_WORKFLOWS"), "lazy": True}
+    if os.environ.get("AMF_DISCOVER"):
+        # AMF_DISCOVER points at the port cache, boards are found by handshake instead of fixed ports
+        fleet.add("default", Beast.discover(cache_path=os.environ["AMF_DISCOVER"], **options))
+    else:
+        fleet.add("default", Beast(**options))
+jobs = JobManager()
+schedulers = {}  # cell id -> LoadScheduler, created on first use
+schedulers_lock = threading.Lock()
+
+# router is mounted twice and each mount picks the cell its routes work on, so the
+# root routes never take a cell_id, not even as a query parameter
+def default_cell(request: Request):
+    request.state.beast = fleet.default
+
+def path_cell(request: Request, cell_id: str):
+    beast = fleet.get(cell_id)
+    if beast is None:
+        raise HTTPException(status_code=404, detail=f"Cell {cell_id} not found")
+    request.state.beast = beast
+
+def get_beast(request: Request) -> Beast:
+    return request.state.beast
+
+def get_scheduler(beast: Beast = Depends(get_beast)) -> LoadScheduler:
+    # Two first requests at once must not start two schedulers for one cell
+    with schedulers_lock:
+        if beast.cell_id not in schedulers:
+            schedulers[beast.cell_id] = LoadScheduler(beast)
+        return schedulers[beast.cell_id]
 
 class SlotChangeRequest(BaseModel):
     slot: int
@@ -14,47 +69,145 @@ class GantryMoveRequest(BaseModel):
 class FilamentLoadRequest(BaseModel):
     amount_secs: int = 60
     speed: int = 1
+    pipelined: bool = False  # Move to storage while staging filament
+
+class LoadRequestModel(BaseModel):
+    printer: str
+    slot: int
+    storage: Optional[str] = None  # Nearest storage unit when not given
+    amount_secs: int = 60
+    speed: int = 1
 
-@app.post("/home")
-def home():
+@router.post("/home")
+async def home(beast: Beast = Depends(get_beast)):
     try:
-        beast.home_state()
+        await beast.home_state_async()
         return {"message": "Gantry homed successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/move")
-def move(request: GantryMoveRequest):
+@router.post("/move")
+async def move(request: GantryMoveRequest, beast: Beast = Depends(get_beast)):
     try:
-        beast.move_gantry_to(request.location)
+        await beast.move_gantry_to_async(request.location)
         return {"message": f"Gantry moved to {request.location}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/set-slot")
-def set_slot(request: SlotChangeRequest):
+@router.post("/set-slot")
+async def set_slot(request: SlotChangeRequest, beast: Beast = Depends(get_beast)):
     try:
         if 1 <= request.slot <= 4:
-            beast.activeSlot = request.slot
-            beast.change_active_slot()
+            beast.activeSlot = FilamentSlot.from_number(request.slot)
+            await beast.change_active_slot_async()
             return {"message": f"Filament slot set to {request.slot}"}
         else:
             raise ValueError("Slot must be between 1 and 4")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.post("/load-gantry")
-def load_gantry(request: FilamentLoadRequest):
-    try:
-        beast.load_gantry_with_filament(request.amount_secs, request.speed)
-        return {"message": "Gantry loaded with filament"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+@router.post("/load-gantry", status_code=202)
+def load_gantry(request: FilamentLoadRequest, beast: Beast = Depends(get_beast)):
+    if request.pipelined:
+        action = beast.load_gantry_pipelined
+    else:
+        action = beast.load_gantry_with_filament
+    job = jobs.submit(beast, "load-gantry", "Gantry loaded with filament",
+                      action, request.amount_secs, request.speed)
+    return {"message": "Gantry load queued", "job_id": job.id}
+
+@router.post("/load-printer", status_code=202)
+def load_printer(beast: Beast = Depends(get_beast)):
+    job = jobs.submit(beast, "load-printer", "Printer loaded with filament",
+                      beast.load_printer_with_filament)
+    return {"message": "Printer load queued", "job_id": job.id}
 
-@app.post("/load-printer")
-def load_printer():
+@router.get("/workflows")
+def list_workflows(beast: Beast = Depends(get_beast)):
+    return [workflow.to_dict() for workflow in beast.workflows.values()]
+
+@router.post("/workflows/{name}", status_code=202)
+def run_workflow(name: str, args: Dict[str, Any] = None, beast: Beast = Depends(get_beast)):
+    if name not in beast.workflows:
+        raise HTTPException(status_code=404, detail=f"Workflow {name} not found")
+    job = jobs.submit(beast, name, f"Workflow {name} finished", lambda: beast.run_workflow(name, **(args or {})))
+    return {"message": f"Workflow {name} queued", "job_id": job.id}
+
+@router.post("/resume", status_code=202)
+def resume(beast: Beast = Depends(get_beast)):
+    job = jobs.submit(beast, "resume", "Workflow resumed and finished", beast.resume)
+    return {"message": "Resume queued", "job_id": job.id}
+
+@router.post("/requests", status_code=202)
+def submit_request(request: LoadRequestModel, scheduler: LoadScheduler = Depends(get_scheduler)):
     try:
-        beast.load_printer_with_filament()
-        return {"message": "Printer loaded with filament"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        load = scheduler.submit(request.printer, request.slot, request.storage, request.amount_secs, request.speed)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "Load request queued", "request_id": load.id}
+
+@router.get("/requests")
+def list_requests(scheduler: LoadScheduler = Depends(get_scheduler)):
+    return [request.to_dict() for request in scheduler.list()]
+
+@router.get("/stations")
+async def list_stations(beast: Beast = Depends(get_beast)):
+    return [station.to_dict() for station in beast.stations]
+
+@router.get("/health")
+def health(response: Response, beast: Beast = Depends(get_beast)):
+    result = beast.health()
+    if not result["ready"]:
+        response.status_code = 503
+    return result
+
+@router.get("/telemetry")
+async def telemetry(request: Request, beast: Beast = Depends(get_beast), last_event_id: Optional[str] = Header(None)):
+    # Server-sent events: the current status, then state changes and device lines as they happen.
+    # Reconnecting clients send Last-Event-ID and continue from there if it is still buffered.
+    # An id from before a server restart starts over, status included.
+    since = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else None
+    if since is not None and not TELEMETRY.knows(since):
+        since = None
+
+    async def stream():
+        if since is None:
+            yield server_sent_event(None, {"type": "status", "cell": beast.cell_id, **beast.status()})
+        async for seq, event in TELEMETRY.subscribe(since):
+            if await request.is_disconnected():
+                break
+            if event is not None and event.get("cell", beast.cell_id) != beast.cell_id:
+                continue
+            yield server_sent_event(seq, event)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.get("/durations")
+async def durations(beast: Beast = Depends(get_beast)):
+    return beast.durations.summary()
+
+@router.get("/status")
+async def status(beast: Beast = Depends(get_beast)):
+    return beast.status()
+
+@app.get("/cells")
+async def list_cells():
+    return fleet.status()
+
+@app.get("/jobs")
+def list_jobs():
+    return [job.to_dict() for job in jobs.list()]
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+@app.get("/metrics")
+def metrics():
+    return Response(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+app.include_router(router, dependencies=[Depends(default_cell)])
+app.include_router(router, prefix="/cells/{cell_id}", dependencies=[Depends(path_cell)])
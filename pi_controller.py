@@ -2,6 +2,7 @@ import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 from tkinter import messagebox
 from gantry_controller import Beast  # Assuming your Beast class is in a file named beast.py
+from storage import FilamentSlot
 
 class GantryControlApp:
     def __init__(self, master):
@@ -9,7 +10,7 @@ class GantryControlApp:
         self.master.title("Gantry Control")
         self.master.geometry("800x480")  # Match the Waveshare LCD resolution
         self.master.attributes("-fullscreen", True)  # Enable full-screen mode
-        self.beast = Beast()
+        self.beast = Beast(lazy=True)
 
         # Main Frame
         self.main_frame = ttk.Frame(master, padding=20)
@@ -84,7 +85,7 @@ class GantryControlApp:
         try:
             slot = int(self.slot_var.get())
             if 1 <= slot <= 4:
-                self.beast.activeSlot = slot
+                self.beast.activeSlot = FilamentSlot.from_number(slot)
                 self.beast.change_active_slot()
                 messagebox.showinfo("Success", f"Filament slot set to {slot}")
             else:
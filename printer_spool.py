@@ -1,19 +1,29 @@
 import time
-from communication import Talker
+from acks import Ack, Outcome, wait_for_ack
+from communication import SensorEvents, Talker
+from state_store import Persisted
+
+SENSOR_TRIGGERED = Ack("Sensor triggered", negative=[r"^Sensor not triggered$"])
+
+class printerSpool(SensorEvents, Persisted):
+    PERSISTED = ("docked",)
 
-class printerSpool:
     def __init__(self, talker: Talker):
         self.talker = talker
+        self.docked = False
 
     def wait_for_intake(self, sensor="intake_sensor", timeout=0.1):
         try:
             command = f"check_intake()"
             self.talker.send(command)
             print(f"Waiting for {sensor} to be triggered...")
-            complete = self._wait_for_ack("Sensor triggered", timeout)
+            complete = wait_for_ack(self.talker, SENSOR_TRIGGERED, timeout)
             if complete:
                 print(f"{sensor} triggered")
                 return True
+            elif complete.outcome == Outcome.NEGATIVE:
+                print(f"{sensor} not triggered yet")
+                return False
             else:
                 print(f"ERROR: {sensor} not triggered within timeout")
                 return False
@@ -26,8 +36,9 @@ class printerSpool:
             command = "dock()"
             self.talker.send(command)
             print("Docking...")
-            complete = self._wait_for_ack("Dock successful.", timeout=5)
+            complete = wait_for_ack(self.talker, "Dock successful.", timeout=5)
             if complete:
+                self.docked = True
                 print("Dock successful")
                 return True
             else:
@@ -42,8 +53,9 @@ class printerSpool:
             command = "undock()"
             self.talker.send(command)
             print("Undocking...")
-            complete = self._wait_for_ack("Undock successful.", timeout=5)
+            complete = wait_for_ack(self.talker, "Undock successful.", timeout=5)
             if complete:
+                self.docked = False
                 print("Undock successful")
                 return True
             else:
@@ -58,7 +70,7 @@ class printerSpool:
             command = f"spool_up({duration}, {max_speed})"
             self.talker.send(command)
             print(f"Spooling up for {duration}s at max speed {max_speed}...")
-            complete = self._wait_for_ack("Spool up complete.", timeout=duration + 25)
+            complete = wait_for_ack(self.talker, "Spool up complete.", timeout=duration + 25)
             if complete:
                 print("Spool up complete")
                 return True
@@ -74,7 +86,7 @@ class printerSpool:
             command = f"spool_up_until({max_speed})"
             self.talker.send(command)
             print(f"Spooling up until stop trigger at max speed {max_speed}...")
-            complete = self._wait_for_ack("RAMP UP", timeout=25)
+            complete = wait_for_ack(self.talker, "RAMP UP", timeout=25)
             if complete:
                 print("Spool up started")
                 return True
@@ -91,7 +103,7 @@ class printerSpool:
             command = "intake_filament()"
             self.talker.send(command)
             print("Intaking filament...")
-            complete = self._wait_for_ack("Intake complete.", timeout=240)
+            complete = wait_for_ack(self.talker, "Intake complete.", timeout=240)
             if complete:
                 print("Intake complete")
                 return True
@@ -104,10 +116,10 @@ class printerSpool:
 
     def stop(self):
         try:
-            self.talker.send("STOP")
+            self.talker.send_blind("STOP")
             print("Stopping...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Operation stopped", timeout=5)
+            complete = wait_for_ack(self.talker, "Operation stopped", timeout=5)
             if complete:
                 print("Operation stopped")
                 return True
@@ -119,22 +131,6 @@ class printerSpool:
             return False
 
     # Helper methods
-    def _wait_for_ack(self, success_message, timeout=30):
-        start_time = time.time()
-        partial_message = success_message[1:]  # Get message without first letter
-        
-        while True:
-            reply = self.talker.receive()
-            print(f"Received: {reply}")
-            
-            if reply == success_message or reply == partial_message:
-                print(success_message)
-                return True
-                
-            # Check if the timeout has been exceeded
-            if time.time() - start_time > timeout:
-                print("Operation timed out.")
-                return False
 
     def _wait_for_response(self, timeout=30):
         start_time = time.time()
@@ -0,0 +1,197 @@
+import argparse
+import os
+import select
+import struct
+import threading
+import time
+import tty
+
+# A capture file is MAGIC, then the wall clock and monotonic time it was opened at,
+# then records of (monotonic time, kind, port id, length) followed by length bytes
+MAGIC = b"AMFCAP1\n"
+FILE_HEADER = struct.Struct("<dd")
+RECORD = struct.Struct("<dBBH")
+
+class Kind:
+    RECEIVED = 0
+    SENT = 1
+    PORT = 2  # Declares a port id, the data is "<name>\0<device>"
+
+class TrafficRecorder:
+    # Append-only log of every byte sent to and received from the boards, shared by
+    # all the Talkers of a Beast. Rotates like logging.handlers.RotatingFileHandler.
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._file = None
+        self._ports = {}  # (name, device) -> port id in the current file
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "ab")
+        self._ports = {}
+        if self._file.tell() == 0:
+            self._file.write(MAGIC + FILE_HEADER.pack(time.time(), time.monotonic()))
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write(self, kind, port_id, data):
+        self._file.write(RECORD.pack(time.monotonic(), kind, port_id, len(data)))
+        self._file.write(data)
+
+    def record(self, name, device, kind, data):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._file.tell() + RECORD.size + len(data) > self.max_bytes:
+                self._rotate()
+            port_id = self._ports.get((name, device))
+            if port_id is None:
+                port_id = self._ports[(name, device)] = len(self._ports)
+                self._write(Kind.PORT, port_id, f"{name}\0{device}".encode("utf-8"))
+            # Longer chunks are split to fit the 16 bit length
+            for start in range(0, len(data), 0xFFFF):
+                self._write(kind, port_id, data[start:start + 0xFFFF])
+            self._file.flush()
+
+    def files(self):
+        return capture_files(self.path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def capture_files(path):
+    # The rotated files of a capture, oldest first
+    backups = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        backups.append(f"{path}.{index}")
+        index += 1
+    return backups[::-1] + ([path] if os.path.exists(path) else [])
+
+def read_capture(paths):
+    # Yields (monotonic time, kind, name, data) for every sent and received chunk
+    for path in paths:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a capture file")
+            f.read(FILE_HEADER.size)
+            names = {}
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break  # End of file, or a record cut short by a crash
+                timestamp, kind, port_id, length = RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                if kind == Kind.PORT:
+                    names[port_id] = data.decode("utf-8").split("\0")[0]
+                else:
+                    yield timestamp, kind, names.get(port_id, str(port_id)), data
+
+class Replayer:
+    # Plays back the received side of a capture on one pseudo-terminal per recorded
+    # port, at the original pace or speed times faster, for a Talker to read from
+    def __init__(self, paths, speed=1.0):
+        self.records = [record for record in read_capture(paths) if record[1] == Kind.RECEIVED]
+        self.speed = speed
+        self._ptys = {}  # name -> (master, slave)
+        for _, _, name, _ in self.records:
+            if name not in self._ptys:
+                master, slave = os.openpty()
+                tty.setraw(slave)
+                self._ptys[name] = (master, slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._play, name="replayer", daemon=True)
+
+    @property
+    def ports(self):
+        # Recorded port name -> device to open in its place
+        return {name: os.ttyname(slave) for name, (_, slave) in self._ptys.items()}
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _play(self):
+        if not self.records:
+            return
+        first = self.records[0][0]
+        start = time.monotonic()
+        for timestamp, _, name, data in self.records:
+            deadline = start + (timestamp - first) / self.speed
+            while time.monotonic() < deadline:
+                if self._stop.is_set():
+                    return
+                self._drain(min(deadline - time.monotonic(), 0.1))
+            try:
+                os.write(self._ptys[name][0], data)
+            except OSError:
+                return
+
+    def _drain(self, timeout):
+        # Discard what the host sends while waiting, the capture already holds the replies
+        masters = [master for master, _ in self._ptys.values()]
+        try:
+            ready, _, _ = select.select(masters, [], [], max(timeout, 0))
+            for master in ready:
+                os.read(master, 1024)
+        except OSError:
+            self._stop.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for master, slave in self._ptys.values():
+            os.close(master)
+            os.close(slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+def dump(paths):
+    first = None
+    for timestamp, kind, name, data in read_capture(paths):
+        if first is None:
+            first = timestamp
+        arrow = "->" if kind == Kind.SENT else "<-"
+        print(f"{timestamp - first:10.4f} {name:>12} {arrow} {data!r}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or replay a serial traffic capture")
+    parser.add_argument("path", help="Capture file, rotated backups are included")
+    parser.add_argument("--replay", action="store_true", help="Replay received data on pseudo-terminals")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed-up factor")
+    args = parser.parse_args()
+    files = capture_files(args.path)
+    if not args.replay:
+        dump(files)
+    else:
+        with Replayer(files, args.speed) as replayer:
+            for name, device in replayer.ports.items():
+                print(f"{name}: {device}")
+            replayer.wait()
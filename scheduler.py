@@ -0,0 +1,140 @@
+import threading
+import time
+import uuid
+from stations import DockType
+from storage import FilamentSlot
+
+class RequestStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+class LoadRequest:
+    def __init__(self, printer, slot, storage=None, amount_secs=60, speed=1):
+        self.id = uuid.uuid4().hex
+        self.printer = printer
+        self.slot = slot
+        self.storage = storage  # None lets the scheduler pick the nearest storage unit
+        self.amount_secs = amount_secs
+        self.speed = speed
+        self.status = RequestStatus.QUEUED
+        self.bypassed = 0  # Times a newer request was served first
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "printer": self.printer,
+            "slot": self.slot,
+            "storage": self.storage,
+            "status": self.status,
+            "bypassed": self.bypassed,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+class LoadScheduler:
+    # Serves "printer X needs slot Y" requests in the order that keeps the gantry
+    # travelling least, grouping requests for the same storage unit and slot
+    SLOT_SWITCH_COST = 200  # Cost of changing slot, in mm of travel
+    MAX_BYPASS = 3          # A request passed over this often is served next
+    MAX_FINISHED = 200
+
+    def __init__(self, beast, max_bypass=None):
+        self.beast = beast
+        self.max_bypass = self.MAX_BYPASS if max_bypass is None else max_bypass
+        self.requests = []
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="load-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, printer, slot, storage=None, amount_secs=60, speed=1):
+        stations = self.beast.stations
+        printer_station = stations.get(printer)
+        if printer_station is None or printer_station.dock_type != DockType.PRINTER:
+            raise ValueError(f"{printer} is not a printer station")
+        if storage is not None and (stations.get(storage) is None
+                                    or stations.get(storage).dock_type != DockType.STORAGE):
+            raise ValueError(f"{storage} is not a storage station")
+        FilamentSlot.from_number(slot)
+        request = LoadRequest(printer, slot, storage, amount_secs, speed)
+        with self._condition:
+            self.requests.append(request)
+            self._condition.notify()
+        return request
+
+    def list(self):
+        with self._condition:
+            return list(self.requests)
+
+    def _storage_for(self, request, position):
+        if request.storage is not None:
+            return request.storage
+        storages = [station.name for station in self.beast.stations.of_type(DockType.STORAGE)]
+        return self.beast.stations.nearest(position, storages)
+
+    def _cost(self, request, position):
+        stations = self.beast.stations
+        storage = self._storage_for(request, position)
+        cost = stations.distance(storage, request.printer)
+        if position in stations:
+            cost += stations.distance(position, storage)
+        # The slot that storage unit was last left on, not the docked one's
+        if FilamentSlot.from_number(request.slot) != self.beast.docks[storage].active_slot:
+            cost += self.SLOT_SWITCH_COST
+        return cost
+
+    def _next(self):
+        queued = [request for request in self.requests if request.status == RequestStatus.QUEUED]
+        if not queued:
+            return None
+        starved = [request for request in queued if request.bypassed >= self.max_bypass]
+        if starved:
+            chosen = starved[0]
+        else:
+            position = self.beast.gantryState.position
+            chosen = min(queued, key=lambda request: self._cost(request, position))
+        for request in queued:
+            if request.created < chosen.created:
+                request.bypassed += 1
+        chosen.status = RequestStatus.RUNNING
+        return chosen
+
+    def _run(self):
+        while True:
+            with self._condition:
+                request = self._next()
+                while request is None:
+                    self._condition.wait()
+                    request = self._next()
+            try:
+                # Runs on the Beast worker so it never interleaves with other commands
+                self.beast.submit(self._serve, request).result()
+                request.status = RequestStatus.DONE
+            except Exception as e:
+                request.error = str(e)
+                request.status = RequestStatus.FAILED
+            request.finished = time.time()
+            with self._condition:
+                self._prune()
+
+    def _serve(self, request):
+        beast = self.beast
+        storage = self._storage_for(request, beast.gantryState.position)
+        beast.undock()
+        beast.move_gantry_to(storage)
+        beast.activeSlot = FilamentSlot.from_number(request.slot)
+        beast.change_active_slot()
+        beast.load_gantry_with_filament(request.amount_secs, request.speed)
+        beast.move_gantry_to(request.printer)
+        beast.load_printer_with_filament()
+        beast.undock()
+
+    def _prune(self):
+        finished = [request for request in self.requests if request.finished is not None]
+        for request in finished[:max(0, len(finished) - self.MAX_FINISHED)]:
+            self.requests.remove(request)
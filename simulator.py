@@ -0,0 +1,458 @@
+import argparse
+import builtins
+import os
+import queue
+import re
+import select
+import threading
+import time
+import traceback
+import tty
+import types
+
+TAGGED_LINE = re.compile(r"^@(\d+) (.*)$")
+STOP_WORDS = ("STOP", "stop")
+
+class Failure:
+    TIMEOUT = "timeout"  # The command never acknowledges
+    ERROR = "error"      # The command raises and the board prints a traceback
+
+class World:
+    # Physical state shared by the boards of one simulated microfactory
+    def __init__(self):
+        self.gantry_intake = False   # Filament from storage reached the gantry sensor
+        self.printer_intake = False  # Filament from the gantry reached the printer sensor
+        self.printer_spooling = False
+        self.boards = {}  # role -> board, for pushing sensor events
+
+    def sensor_edge(self, role, event):
+        board = self.boards.get(role)
+        if board is not None:
+            board.push_event(event)
+
+class VirtualYukon:
+    ROLE = None
+    STATION = None  # Reported by identify()
+    LATENCIES = {}
+
+    def __init__(self, world=None, latencies=None, failures=None, scale=1.0):
+        self.world = world or World()
+        self.latencies = dict(self.LATENCIES)
+        self.latencies.update(latencies or {})
+        self.failures = dict(failures or {})
+        self.scale = scale
+        self.world.boards[self.ROLE] = self
+        self.events = False  # Set by subscribe_events()
+        self._started = time.monotonic()
+        self.commands = []  # Every line executed at the REPL, for inspection
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._input = queue.Queue()
+        self._framed_input = {}  # Tag of each command running in framed mode -> its input
+        self._local = threading.local()     # Tag of the framed command run by this thread
+        self._running = True
+        self.namespace = {"print": self.print, "__builtins__": dict(vars(builtins), __import__=self._import)}
+        self.namespace.update(self.functions())
+        self._threads = [
+            threading.Thread(target=self._read, name=f"{self.ROLE}-sim-reader", daemon=True),
+            threading.Thread(target=self._repl, name=f"{self.ROLE}-sim-repl", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def functions(self):
+        return {"dock": self.dock, "undock": self.undock, "subscribe_events": self.subscribe_events,
+                "identify": self.identify}
+
+    def _import(self, name, *args, **kwargs):
+        # The MicroPython time module, with ticks_ms counted from when the board started
+        if name in ("time", "utime"):
+            return types.SimpleNamespace(ticks_ms=self.ticks_ms, sleep=self.sleep)
+        return builtins.__import__(name, *args, **kwargs)
+
+    def ticks_ms(self):
+        return int((time.monotonic() - self._started) * 1000)
+
+    def close(self):
+        self._running = False
+        self._input.put(None)
+        for thread in self._threads:
+            thread.join(1)
+        os.close(self.master)
+        os.close(self._slave)
+
+    def print(self, *args):
+        text = " ".join(str(arg) for arg in args)
+        tag = getattr(self._local, "tag", None)
+        if tag is not None:
+            text = f"@{tag} {text}"
+        self._write(text + "\r\n")
+
+    def _write(self, text):
+        try:
+            os.write(self.master, text.encode("utf-8"))
+        except OSError:
+            pass
+
+    def _read(self):
+        buffer = b""
+        while self._running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            buffer += data
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                line = line.decode("utf-8", errors="replace").strip("\f\n ")
+                if line:
+                    self._input.put(line)
+
+    def _repl(self):
+        self._write(">>> ")
+        while self._running:
+            line = self._input.get()
+            if line is None:
+                return
+            framed = TAGGED_LINE.match(line)
+            if framed:
+                self._start_framed(int(framed.group(1)), framed.group(2))
+                continue
+            self._write(line + "\r\n")  # Echo like the MicroPython REPL
+            self.commands.append(line)
+            self._execute(line)
+            self._write(">>> ")
+
+    def _start_framed(self, tag, source):
+        # Framed commands are not echoed and run side by side, replies carry the tag.
+        # A line tagged like a running command is input for that command, and a stop
+        # word under any other tag stops every running command.
+        running = self._framed_input.get(tag)
+        if running is not None:
+            running.put(source)
+            return
+        if source in STOP_WORDS:
+            for framed_input in list(self._framed_input.values()):
+                framed_input.put(source)
+            return
+        self.commands.append(source)
+        self._framed_input[tag] = queue.Queue()
+        threading.Thread(target=self._run_framed, args=(tag, source), daemon=True).start()
+
+    def _run_framed(self, tag, source):
+        self._local.tag = tag
+        try:
+            self._execute(source)
+        finally:
+            del self._framed_input[tag]
+
+    def _execute(self, source):
+        try:
+            try:
+                code = compile(source, "<stdin>", "eval")
+            except SyntaxError:
+                exec(compile(source, "<stdin>", "exec"), self.namespace)
+            else:
+                result = eval(code, self.namespace)
+                if result is not None:
+                    self.print(repr(result))
+        except Exception as e:
+            self.print("Traceback (most recent call last):")
+            self.print('  File "<stdin>", line 1, in <module>')
+            self.print("".join(traceback.format_exception_only(type(e), e)).strip())
+
+    def poll_input(self):
+        # Input typed while a command is running is read by the command, like input() would
+        tag = getattr(self._local, "tag", None)
+        if tag is not None:
+            try:
+                return self._framed_input[tag].get_nowait()
+            except queue.Empty:
+                return None
+        try:
+            line = self._input.get_nowait()
+        except queue.Empty:
+            return None
+        if line is None:
+            self._input.put(None)
+        else:
+            self._write(line + "\r\n")
+        return line
+
+    def sleep(self, seconds):
+        deadline = time.monotonic() + seconds * self.scale
+        while self._running and time.monotonic() < deadline:
+            time.sleep(min(0.01, max(0.0, deadline - time.monotonic())))
+
+    def step(self, name):
+        # Applies latency and failure injection, False means "do not acknowledge"
+        mode = self.failures.get(name)
+        if mode == Failure.ERROR:
+            raise RuntimeError(f"injected failure in {name}")
+        self.sleep(self.latencies.get(name, 0))
+        return mode != Failure.TIMEOUT
+
+    def run_until_stop(self, name, stop_words, on_elapsed=None):
+        # Runs a continuous action until the host types one of stop_words
+        start = time.monotonic()
+        fired = False
+        while self._running:
+            if self.poll_input() in stop_words:
+                return True
+            if not fired and on_elapsed and time.monotonic() - start >= self.latencies.get(name, 0) * self.scale:
+                fired = True
+                on_elapsed()
+            time.sleep(0.005)
+        return False
+
+    def identify(self):
+        self.print(f"IDENTITY {self.STATION} {id(self):x}")
+
+    def subscribe_events(self):
+        self.events = True
+        self.print("Events subscribed")
+
+    def push_event(self, event):
+        if self.events:
+            self._write(f"EVENT {event} {self.ticks_ms()}\r\n")
+
+    def dock(self):
+        if self.step("dock"):
+            self.print("Dock successful.")
+
+    def undock(self):
+        if self.step("undock"):
+            self.print("Undock successful.")
+
+class GantryBoard(VirtualYukon):
+    ROLE = "gantry"
+    STATION = "gantry"
+    LATENCIES = {
+        "home": 2.0,
+        "move": 1.5,
+        "dock": 0.5,
+        "undock": 0.5,
+        "intake_filament": 1.0,
+        "spool_up": 3.0,
+        "spool_up_until": 0.5,
+        "retreiveFilament": 1.5,
+        "deliverFilamentUntil": 1.0,
+        "deliverFilament": 0.5,
+        "unspool": 1.0,
+        "unspoolTension": 0.2,
+        "filament_off_spool": 2.0,
+    }
+
+    def functions(self):
+        functions = super().functions()
+        for name in ["home", "move_left", "move_right", "check_intake", "intake_filament",
+                     "spool_up", "spool_up_until", "retreiveFilament", "deliverFilamentUntil",
+                     "deliverFilament", "unspool", "unspoolTension"]:
+            functions[name] = getattr(self, name)
+        return functions
+
+    def home(self):
+        if self.step("home"):
+            self.print("Home Success")
+
+    def move_left(self, steps):
+        if self.step("move"):
+            self.print("Movement Successful")
+
+    def move_right(self, steps):
+        if self.step("move"):
+            self.print("Movement Successful")
+
+    def check_intake(self):
+        if self.step("check_intake"):
+            self.print("Locked and Loaded" if self.world.gantry_intake else "Intake empty")
+
+    def intake_filament(self):
+        if self.step("intake_filament"):
+            self.print("Intake successful.")
+
+    def spool_up(self, spool_time, speed):
+        if self.step("spool_up"):
+            self.print("Spool successful.")
+
+    def spool_up_until(self, speed):
+        if self.step("spool_up_until"):
+            self.print("**Full Speed Phase**")
+
+    def retreiveFilament(self):
+        if self.step("retreiveFilament"):
+            self.world.gantry_intake = False
+            self.print("Filament retrieved.")
+
+    def deliverFilamentUntil(self):
+        if not self.step("deliverFilamentUntil_start"):
+            return
+        self.print("Filament delivery started")
+
+        def reached_printer():
+            self.world.printer_intake = True
+            self.world.sensor_edge("printer", "intake")
+        if self.run_until_stop("deliverFilamentUntil", STOP_WORDS, reached_printer):
+            self.print("Filament delivery stopped")
+
+    def deliverFilament(self, length):
+        if self.step("deliverFilament"):
+            self.print("Filament delivered successfully.")
+
+    def unspool(self):
+        if self.step("unspool"):
+            self.print("Unspool successful.")
+
+    def unspoolTension(self):
+        if not self.step("unspoolTension"):
+            return
+        self.print("Tension off.")
+        if self.world.printer_spooling and self.step("filament_off_spool"):
+            self.world.printer_intake = False
+            self.print("Filament off spool.")
+
+class _Slot:
+    def __init__(self, board, name):
+        self.board = board
+        self.name = name
+
+    def deliver_filament_until(self):
+        board = self.board
+        if not board.step("deliver_filament_until_start"):
+            return
+        board.print("Filament delivery started")
+
+        def reached_gantry():
+            board.world.gantry_intake = True
+            board.world.sensor_edge("gantry", "intake")
+        if board.run_until_stop("deliver_filament_until", STOP_WORDS, reached_gantry):
+            board.print("Filament delivery stopped")
+
+    def deliver_filament(self, amount):
+        if self.board.step("deliver_filament"):
+            self.board.print("Filament delivery successful.")
+
+    def little_push(self):
+        if self.board.step("little_push"):
+            self.board.print("Little push successful.")
+
+    def pull_out(self):
+        if self.board.step("pull_out"):
+            self.board.print("Pull out successful.")
+
+class StorageBoard(VirtualYukon):
+    ROLE = "storage"
+    STATION = "storage_1"
+    SLOTS = ["stepper_TL", "stepper_TR", "stepper_BL", "stepper_BR"]
+    LATENCIES = {
+        "dock": 0.5,
+        "undock": 0.5,
+        "deliver_filament_until": 1.0,
+        "deliver_filament": 0.5,
+        "little_push": 0.2,
+        "pull_out": 0.5,
+        "cutFilament": 0.5,
+    }
+
+    def functions(self):
+        functions = super().functions()
+        functions["cutFilament"] = self.cutFilament
+        for slot in self.SLOTS:
+            functions[slot] = _Slot(self, slot)
+        return functions
+
+    def cutFilament(self):
+        if self.step("cutFilament"):
+            self.print("Filament cutting successful.")
+
+class PrinterBoard(VirtualYukon):
+    ROLE = "printer"
+    STATION = "printer_1"
+    LATENCIES = {
+        "dock": 0.5,
+        "undock": 0.5,
+        "intake_filament": 1.0,
+        "spool_up": 2.0,
+        "spool_up_until": 0.2,
+    }
+
+    def functions(self):
+        functions = super().functions()
+        for name in ["check_intake", "intake_filament", "spool_up", "spool_up_until"]:
+            functions[name] = getattr(self, name)
+        return functions
+
+    def check_intake(self):
+        if self.step("check_intake"):
+            self.print("Sensor triggered" if self.world.printer_intake else "Sensor not triggered")
+
+    def intake_filament(self):
+        if self.step("intake_filament"):
+            self.print("Intake complete.")
+
+    def spool_up(self, duration, max_speed):
+        if self.step("spool_up"):
+            self.print("Spool up complete.")
+
+    def spool_up_until(self, max_speed):
+        if not self.step("spool_up_until"):
+            return
+        self.print("RAMP UP")
+        self.world.printer_spooling = True
+        try:
+            if self.run_until_stop("spool_up_until_run", STOP_WORDS):
+                self.print("Operation stopped")
+        finally:
+            self.world.printer_spooling = False
+
+class VirtualMicrofactory:
+    # One gantry, storage and printer board sharing a World, ready for Beast(**factory.ports)
+    def __init__(self, latencies=None, failures=None, scale=1.0):
+        # latencies and failures are keyed by board role, e.g. {"gantry": {"home": 0.1}}
+        latencies = latencies or {}
+        failures = failures or {}
+        self.world = World()
+        self.boards = {}
+        for board_class in [GantryBoard, StorageBoard, PrinterBoard]:
+            role = board_class.ROLE
+            self.boards[role] = board_class(self.world, latencies.get(role), failures.get(role), scale)
+
+    @property
+    def ports(self):
+        return {
+            "g_pico": self.boards["gantry"].port,
+            "s_pico": self.boards["storage"].port,
+            "p_pico": self.boards["printer"].port,
+        }
+
+    def set_scale(self, scale):
+        for board in self.boards.values():
+            board.scale = scale
+
+    def close(self):
+        for board in self.boards.values():
+            board.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run virtual Yukon boards on pseudo-terminals")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for every device latency")
+    args = parser.parse_args()
+
+    with VirtualMicrofactory(scale=args.scale) as factory:
+        for name, port in factory.ports.items():
+            print(f"{name}: {port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
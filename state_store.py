@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import threading
+
+def write_json_atomic(path, data, indent=None):
+    # Readers see the old file or the new one, never a partial write
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".state-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class StateStore:
+    # Small JSON file rewritten atomically on every change
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self._lock:
+            return dict(self.state.get(key, {}))
+
+    def update(self, key, values):
+        with self._lock:
+            entry = self.state.setdefault(key, {})
+            if all(entry.get(name) == value for name, value in values.items()):
+                return
+            entry.update(values)
+            write_json_atomic(self.path, self.state)
+
+class Persisted:
+    # Subclasses list in PERSISTED the attributes saved whenever they are assigned
+    # and reported to watchers whenever their value changes
+    PERSISTED = ()
+
+    def watch(self, callback):
+        # callback(name, value) runs on the thread that made the change
+        self.__dict__.setdefault("_watchers", []).append(callback)
+
+    def attach_store(self, store, key):
+        self._store = store
+        self._store_key = key
+        store.update(key, self.snapshot())
+
+    def snapshot(self):
+        values = {name: getattr(self, name, None) for name in self.PERSISTED}
+        talker = self.__dict__.get("talker")
+        if talker is not None:
+            values["last_command"] = talker.last_command
+        return values
+
+    def restore(self, values):
+        for name in self.PERSISTED:
+            if name in values:
+                setattr(self, name, values[name])
+        talker = self.__dict__.get("talker")
+        if talker is not None and values.get("last_command"):
+            talker.last_command = values["last_command"]
+
+    def __setattr__(self, name, value):
+        if name not in self.PERSISTED:
+            super().__setattr__(name, value)
+            return
+        changed = name not in self.__dict__ or self.__dict__[name] != value
+        super().__setattr__(name, value)
+        if self.__dict__.get("_store") is not None:
+            self._store.update(self._store_key, self.snapshot())
+        if changed:
+            for callback in self.__dict__.get("_watchers", ()):
+                callback(name, value)
@@ -0,0 +1,69 @@
+import json
+
+class DockType:
+    NONE = "none"
+    STORAGE = "storage"
+    PRINTER = "printer"
+
+class Station:
+    def __init__(self, name, offset, dock_type=DockType.NONE, port=None):
+        self.name = name
+        self.offset = offset        # Position along the rail in mm from home
+        self.dock_type = dock_type  # Which kind of board docks the gantry here
+        self.port = port            # Serial port of that board, if any
+
+    def to_dict(self):
+        return {"name": self.name, "offset": self.offset, "dock_type": self.dock_type, "port": self.port}
+
+class StationTable:
+    def __init__(self, stations):
+        self.stations = sorted(stations, key=lambda station: station.offset)
+        self._by_name = {station.name: station for station in self.stations}
+        if len(self._by_name) != len(self.stations):
+            raise ValueError("Station names must be unique")
+
+    @classmethod
+    def default(cls):
+        return cls([
+            Station("home", 0),
+            Station("storage_1", 500, DockType.STORAGE),
+            Station("printer_1", 1000, DockType.PRINTER),
+        ])
+
+    @classmethod
+    def load(cls, path):
+        # JSON list of {"name", "offset", "dock_type", "port"} objects
+        with open(path) as f:
+            return cls([Station(**entry) for entry in json.load(f)])
+
+    def __iter__(self):
+        return iter(self.stations)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def names(self):
+        return [station.name for station in self.stations]
+
+    def of_type(self, dock_type):
+        return [station for station in self.stations if station.dock_type == dock_type]
+
+    def distance(self, a, b):
+        return abs(self._by_name[a].offset - self._by_name[b].offset)
+
+    def nearest(self, origin, candidates):
+        # Shortest travel from origin, ties go to the first candidate
+        return min(candidates, key=lambda name: self.distance(origin, name))
+
+    def plan(self, current, target):
+        # The firmware counts station markers, towards higher offsets is move_left
+        names = self.names()
+        steps = names.index(target) - names.index(current)
+        if steps > 0:
+            return f"move_left({steps})", steps
+        if steps < 0:
+            return f"move_right({-steps})", -steps
+        return None, 0
@@ -1,4 +1,6 @@
+from acks import wait_for_ack
 from communication import Talker
+from state_store import Persisted
 import time
 
 class FilamentSlot:
@@ -7,11 +9,22 @@ class FilamentSlot:
     THREE = "stepper_BL"
     FOUR = "stepper_BR"
 
-class FilamentHandler:
+    @staticmethod
+    def from_number(number):
+        # Slots are numbered 1-4 in the API and GUI
+        slots = [FilamentSlot.ONE, FilamentSlot.TWO, FilamentSlot.THREE, FilamentSlot.FOUR]
+        if not 1 <= number <= len(slots):
+            raise ValueError("Slot must be between 1 and 4")
+        return slots[number - 1]
+
+class FilamentHandler(Persisted):
+    PERSISTED = ("state", "active_slot", "docked")
+
     def __init__(self, talker: Talker):
         self.talker = talker
         self.state = "idle"
         self.active_slot = None
+        self.docked = False
 
     def change_slot(self, slot):
         self.active_slot = slot
@@ -24,8 +37,9 @@ class FilamentHandler:
             self.talker.send(command)
             print("Docking...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Dock successful.")
+            complete = wait_for_ack(self.talker, "Dock successful.")
             if complete:
+                self.docked = True
                 print("Dock Successful")
                 return True
             else:
@@ -41,7 +55,7 @@ class FilamentHandler:
             self.talker.send(command)
             print("Delivering filament...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament delivery started")
+            complete = wait_for_ack(self.talker, "Filament delivery started")
             if complete:
                 print("Filament delivery started successfully")
                 return True
@@ -58,7 +72,7 @@ class FilamentHandler:
             self.talker.send(command)
             print("Cutting filament...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament cutting successful.")
+            complete = wait_for_ack(self.talker, "Filament cutting successful.")
             if complete:
                 print("Cutting filament successful")
                 return True
@@ -75,7 +89,7 @@ class FilamentHandler:
             self.talker.send(command)
             print("Pushing filament slightly...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Little push successful.")
+            complete = wait_for_ack(self.talker, "Little push successful.")
             if complete:
                 print("Little push successful")
                 return True
@@ -92,7 +106,7 @@ class FilamentHandler:
             self.talker.send(command)
             print("Pulling out...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Pull out successful.")
+            complete = wait_for_ack(self.talker, "Pull out successful.")
             if complete:
                 print("Pull out successful")
                 return True
@@ -109,7 +123,7 @@ class FilamentHandler:
             self.talker.send(command)
             print("Pushing filament slightly...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament delivery successful.")
+            complete = wait_for_ack(self.talker, "Filament delivery successful.")
             if complete:
                 print("Extrusion successful")
                 return True
@@ -120,14 +134,34 @@ class FilamentHandler:
             print(f"Error: {e}")
             return False
 
+    def stage_filament(self, amount):
+        # Advance filament towards the exit while the gantry is still travelling
+        try:
+            command = f"{self.active_slot}.deliver_filament({amount})"
+            self.talker.send(command)
+            print(f"Staging {amount}mm of filament...")
+            time.sleep(0.1)
+            complete = wait_for_ack(self.talker, "Filament delivery successful.")
+            if complete:
+                self.state = "staged"
+                print("Staging successful")
+                return True
+            else:
+                print("ERROR: Staging unsuccessful")
+                return False
+        except ValueError as e:
+            print(f"Error: {e}")
+            return False
+
     def undock(self):
         try:
             command = "undock()"
             self.talker.send(command)
             print("Undocking...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Undock successful.")
+            complete = wait_for_ack(self.talker, "Undock successful.")
             if complete:
+                self.docked = False
                 print("Undocking successful")
                 return True
             else:
@@ -142,41 +176,24 @@ class FilamentHandler:
             self.talker.send_blind("stop")
             print("Stopping...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament delivery stopped", 5)
+            complete = wait_for_ack(self.talker, "Filament delivery stopped", 5)
             if complete:
                 print("Delivery Stopped")
                 return True
             self.talker.send("stop")
             print("Stopping...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament delivery stopped", 10)
+            complete = wait_for_ack(self.talker, "Filament delivery stopped", 10)
             if complete:
                 print("Delivery Stopped")
                 return True
             self.talker.send("stop")
             print("Stopping...")
             time.sleep(0.1)
-            complete = self._wait_for_ack("Filament delivery stopped", 15)
+            complete = wait_for_ack(self.talker, "Filament delivery stopped", 15)
             if complete:
                 print("Delivery Stopped")
                 return True
         except ValueError as e:
             print(f"Error: {e}")
             return False
-
-    def _wait_for_ack(self, success_message, timeout=30):
-        start_time = time.time()
-        partial_message = success_message[1:]  # Get message without first letter
-        
-        while True:
-            reply = self.talker.receive()
-            print(f"Received: {reply}")
-            
-            if reply == success_message or reply == partial_message:
-                print(success_message)
-                return True
-                
-            # Check if the timeout has been exceeded
-            if time.time() - start_time > timeout:
-                print("Operation timed out.")
-                return False
\ No newline at end of file
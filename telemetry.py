@@ -0,0 +1,87 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+class Broadcast:
+    # One buffer of recent events shared by every subscriber. Publishing never blocks,
+    # a subscriber that falls more than SIZE events behind skips ahead and is told
+    # how many events it missed.
+    SIZE = 1000
+
+    def __init__(self, size=None):
+        self._events = deque(maxlen=size or self.SIZE)  # (sequence number, event)
+        self._next_seq = 0
+        self._lock = threading.Lock()
+        self._waiters = set()  # (event loop, asyncio.Event) of every idle subscriber
+
+    def publish(self, event):
+        # Safe to call from any thread
+        event.setdefault("time", time.time())
+        with self._lock:
+            self._events.append((self._next_seq, event))
+            self._next_seq += 1
+            waiters = list(self._waiters)
+        for loop, ready in waiters:
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                with self._lock:
+                    self._waiters.discard((loop, ready))
+
+    def since(self, seq):
+        # Events from seq on, and how many events after seq were already dropped
+        with self._lock:
+            first = self._events[0][0] if self._events else self._next_seq
+            dropped = max(0, first - seq)
+            events = list(itertools.islice(self._events, max(0, seq - first), None))
+        return events, dropped
+
+    def knows(self, seq):
+        # False for a sequence number this buffer never reached, like one a client
+        # kept from before a restart, since numbering starts again at 0
+        with self._lock:
+            return seq <= self._next_seq
+
+    async def subscribe(self, since=None, heartbeat=15):
+        # Yields (sequence number, event). A gap is reported as a "dropped" event with
+        # no sequence number, and (None, None) is yielded after heartbeat idle seconds.
+        # A since this buffer never reached subscribes afresh.
+        ready = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), ready)
+        with self._lock:
+            self._waiters.add(waiter)
+            cursor = self._next_seq if since is None or since > self._next_seq else since
+        try:
+            while True:
+                ready.clear()
+                events, dropped = self.since(cursor)
+                if dropped:
+                    cursor += dropped
+                    yield None, {"type": "dropped", "count": dropped}
+                for seq, event in events:
+                    cursor = seq + 1
+                    yield seq, event
+                if events or dropped:
+                    continue
+                try:
+                    await asyncio.wait_for(ready.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None, None
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+def server_sent_event(seq, event):
+    if event is None:
+        return ": heartbeat\n\n"
+    lines = [] if seq is None else [f"id: {seq}"]
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event)}")
+    return "\n".join(lines) + "\n\n"
+
+# Shared by every cell in the process
+TELEMETRY = Broadcast()
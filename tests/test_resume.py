@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gantry_controller import Beast
+from simulator import Failure, VirtualMicrofactory
+from storage import FilamentSlot
+from workflows import WorkflowError
+
+SCALE = 0.05
+
+@pytest.fixture
+def factory():
+    with VirtualMicrofactory(scale=SCALE) as factory:
+        beast = Beast(**factory.ports)
+        beast.storageState.change_slot(FilamentSlot.ONE)
+        beast.home_state()
+        beast.move_gantry_to("storage_1")
+        yield factory, beast
+        beast.close()
+
+def fail_then_resume(factory, beast, load, role, command, slow):
+    # Fails one branch of a parallel pair while the other branch, slowed down by
+    # slow = (role, command), is still running, then resumes once the fault is cleared
+    factory.boards[role].failures[command] = Failure.ERROR
+    factory.boards[slow[0]].latencies[slow[1]] = 20.0
+    with pytest.raises(WorkflowError):
+        load()
+    assert beast.checkpoint["failed"]
+    factory.boards[role].failures.clear()
+    factory.boards[slow[0]].latencies.pop(slow[1])
+    beast.resume()
+    assert beast.checkpoint["error"] is None
+    assert beast.checkpoint["done"] and not beast.checkpoint["failed"]
+
+@pytest.mark.parametrize("role, command, slow", [
+    ("gantry", "retreiveFilament", ("storage", "pull_out")),
+    ("storage", "pull_out", ("gantry", "retreiveFilament")),
+])
+def test_resume_load_gantry_branch(factory, role, command, slow):
+    factory, beast = factory
+    fail_then_resume(factory, beast, beast.load_gantry_with_filament, role, command, slow)
+    assert set(beast.checkpoint["done"]) == set(beast.workflows["load_gantry"].names())
+
+@pytest.mark.parametrize("role, command, slow", [
+    ("gantry", "unspoolTension", ("printer", "spool_up_until")),
+    ("printer", "spool_up_until", ("gantry", "unspoolTension")),
+])
+def test_resume_load_printer_branch(factory, role, command, slow):
+    factory, beast = factory
+    beast.load_gantry_with_filament()
+    beast.move_gantry_to("printer_1")
+    fail_then_resume(factory, beast, beast.load_printer_with_filament, role, command, slow)
+    assert set(beast.checkpoint["done"]) == set(beast.workflows["load_printer"].names())
@@ -0,0 +1,207 @@
+import contextvars
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+class WorkflowError(Exception):
+    pass
+
+_step = threading.local()
+
+def cancelled():
+    # True inside a step that timed out or whose workflow failed, for steps that loop
+    cancel = getattr(_step, "cancel", None)
+    return cancel is not None and cancel.is_set()
+
+class Step:
+    def __init__(self, name, boards, action, args=(), after=None, timeout=None, compensate=None, until=None):
+        self.name = name
+        self.boards = (boards,) if isinstance(boards, str) else tuple(boards)  # Never used by two steps at once
+        # action and compensate are names in the actions table the workflow runs with.
+        # args are passed to the action, "$name" stands for the workflow parameter name.
+        self.action = action
+        self.args = tuple(args)
+        # Steps that must succeed first, None for just the step listed before this one
+        self.after = None if after is None else tuple(after)
+        self.timeout = timeout  # Seconds
+        # Leaves the boards safe when this step fails. With until, the name of the step
+        # that ends what this one starts, it also runs when the workflow fails after
+        # this step succeeded but before that one did. A compensated step runs again
+        # on resume.
+        self.compensate = compensate
+        self.until = until
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], data["boards"], data["action"], data.get("args", ()), data.get("after"),
+                   data.get("timeout"), data.get("compensate"), data.get("until"))
+
+    def to_dict(self):
+        return {"name": self.name, "boards": list(self.boards), "action": self.action, "args": list(self.args),
+                "after": None if self.after is None else list(self.after), "timeout": self.timeout,
+                "compensate": self.compensate, "until": self.until}
+
+class Workflow:
+    # Steps run as soon as the steps they come after have succeeded and their boards
+    # are free, so independent steps on different boards overlap. A checkpoint is
+    # recorded whenever a step starts and ends, so a run that failed or was cut short
+    # by a restart can be resumed with only the steps that did not succeed.
+    def __init__(self, name, steps, params=None):
+        self.name = name
+        self.steps = steps
+        self.params = params or {}  # Parameter name -> default
+        names = set()
+        for index, step in enumerate(steps):
+            if step.after is None:
+                step.after = (steps[index - 1].name,) if index else ()
+            unknown = [name for name in step.after if name not in names]
+            if unknown:
+                # Only earlier steps, which also rules out cycles
+                raise WorkflowError(f"Step \"{step.name}\" of {name} comes after unknown or later steps {unknown}")
+            names.add(step.name)
+        for step in steps:
+            if step.until is not None and step.until not in names:
+                raise WorkflowError(f"Step \"{step.name}\" of {name} lasts until unknown step \"{step.until}\"")
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], [Step.from_dict(step) for step in data["steps"]], data.get("params"))
+
+    def to_dict(self):
+        return {"name": self.name, "params": self.params, "steps": [step.to_dict() for step in self.steps]}
+
+    def names(self):
+        return [step.name for step in self.steps]
+
+    def arguments(self, args):
+        unknown = set(args) - set(self.params)
+        if unknown:
+            raise WorkflowError(f"Unknown parameters {sorted(unknown)} for {self.name}")
+        return {**self.params, **args}
+
+    def run(self, actions, args, pool, on_checkpoint, checkpoint=None, explain=None):
+        # actions maps action names to callables that raise or return False on failure.
+        # Steps run on pool. on_checkpoint(checkpoint, succeeded, step) is called with
+        # succeeded None when a step starts, True or False when one ends, and with
+        # step None once the workflow has ended.
+        # explain() is called in the step's thread when an action returned False and
+        # gives the reason, or None if there is none to add.
+        used = {step.action for step in self.steps} | {step.compensate for step in self.steps if step.compensate}
+        missing = sorted(used - set(actions))
+        if missing:
+            raise WorkflowError(f"Workflow {self.name} uses unknown actions {missing}")
+        args = self.arguments(args)
+        done = list(checkpoint["done"]) if checkpoint else []
+        current = {"workflow": self.name, "args": args, "done": done, "running": [], "failed": [],
+                   "compensated": [], "error": None, "finished": None,
+                   "started": checkpoint["started"] if checkpoint else time.time()}
+        pending = [step for step in self.steps if step.name not in done]
+        running = {}  # future -> (step, deadline, cancel event)
+        # Steps run in the context of their first board, so in framed mode input such
+        # as STOP joins the request an earlier step started on that board
+        contexts = {}
+        errors = []
+
+        def report(succeeded, step=None):
+            current["running"] = [other.name for other, _, _ in running.values()]
+            on_checkpoint(dict(current, done=list(done), failed=list(current["failed"])), succeeded, step)
+
+        while pending or running:
+            busy = {board for step, _, _ in running.values() for board in step.boards}
+            for step in list(pending):
+                if errors:
+                    break
+                if any(name not in done for name in step.after) or busy.intersection(step.boards):
+                    continue
+                pending.remove(step)
+                busy.update(step.boards)
+                values = [args[arg[1:]] if isinstance(arg, str) and arg.startswith("$") else arg for arg in step.args]
+                cancel = threading.Event()
+                context = contexts.setdefault(step.boards[0], contextvars.Context())
+                future = pool.submit(context.run, self._call, actions[step.action], values, cancel, explain)
+                deadline = None if step.timeout is None else time.monotonic() + step.timeout
+                running[future] = (step, deadline, cancel)
+                report(None, step)
+            if not running:
+                break
+            deadlines = [deadline for _, deadline, _ in running.values() if deadline is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            finished, _ = wait(list(running), timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, _, _ = running.pop(future)
+                try:
+                    success, reason = future.result()
+                except Exception as e:
+                    success, error = False, str(e)
+                else:
+                    error = f"Error: Expected \"{step.name}\" but action failed"
+                    if reason:
+                        error += f": {reason}"
+                if success is False:
+                    current["failed"].append(step.name)
+                    errors.append(error)
+                    report(False, step)
+                else:
+                    done.append(step.name)
+                    report(True, step)
+            for future, (step, deadline, cancel) in list(running.items()):
+                if deadline is not None and time.monotonic() >= deadline:
+                    # The step's thread is left to notice cancelled() or finish on its own
+                    cancel.set()
+                    del running[future]
+                    current["failed"].append(step.name)
+                    errors.append(f"Error: \"{step.name}\" timed out after {step.timeout}s")
+                    report(False, step)
+            if errors:
+                for _, _, cancel in running.values():
+                    cancel.set()
+
+        if errors:
+            self._compensate(actions, current, done, contexts)
+            current["error"] = "; ".join(errors)
+        current["finished"] = time.time()
+        report(not errors)
+        if errors:
+            raise WorkflowError(current["error"])
+
+    def _call(self, action, values, cancel, explain):
+        # Returns the action's result and, if it returned False, the reason for it
+        _step.cancel = cancel
+        try:
+            success = action(*values)
+            return success, explain() if success is False and explain is not None else None
+        finally:
+            _step.cancel = None
+
+    def _compensate(self, actions, current, done, contexts):
+        # Failed steps first, then the steps that succeeded, latest first
+        steps = {step.name: step for step in self.steps}
+        for name in current["failed"][::-1] + done[::-1]:
+            step = steps[name]
+            if step.compensate is None:
+                continue
+            if name in done and (step.until is None or step.until in done):
+                continue
+            print(f"Compensating {name} with {step.compensate}")
+            try:
+                # A copy, a step that timed out may still be running in the context
+                context = contexts.get(step.boards[0], contextvars.Context()).copy()
+                success = context.run(actions[step.compensate])
+            except Exception as e:
+                success = False
+                print(f"Error: {e}")
+            if success is False:
+                print(f"Error: Compensation {step.compensate} of {name} failed")
+                continue
+            current["compensated"].append(name)
+            if name in done:
+                done.remove(name)
+
+def load_workflows(path):
+    # JSON {"workflows": [{"name", "params", "steps": [{"name", "boards", "action", ...}]}]}
+    with open(path) as f:
+        return [Workflow.from_dict(data) for data in json.load(f)["workflows"]]
+
+def resumable(checkpoint):
+    return checkpoint is not None and bool(checkpoint.get("failed") or checkpoint.get("running"))